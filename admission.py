@@ -0,0 +1,321 @@
+"""
+Admission control for the expensive routes.
+
+The app runs on a single event loop, so a burst of CPU-heavy matching or
+bcrypt-heavy logins slows every route down together. Requests to a limited
+route first take a token from their client's bucket for that route, then
+wait for a slot: at most `slots` limited requests run at once, each route
+at most its own concurrency. Waiters are admitted by priority class, then
+arrival, so cheap reads overtake queued matching.
+
+A request is shed with 503 and Retry-After when its route's queue is full,
+or when the expected wait plus the route's typical service time would
+exceed its deadline, either on arrival or once it has waited that long. A
+client out of tokens gets 429 and Retry-After.
+
+WebSocket sessions bypass the middleware. They count against a per client
+session limit and take a token from a route's bucket per message instead.
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import namedtuple
+
+from starlette.responses import JSONResponse
+from starlette.routing import Match
+
+from cache import LRUCache
+from metrics import ADMISSION_ACTIVE, ADMISSION_QUEUED, ADMISSION_SHED, ADMISSION_WAIT, phase
+
+
+# Priority classes, earlier ones are admitted first
+PRIORITIES = ("read", "heavy")
+
+SERVICE_SMOOTHING = 0.2  # weight of the newest request in a route's service time average
+BUCKETS_SIZE = 100000  # clients x routes with a token bucket, least recent are reset
+
+# priority - str one of PRIORITIES
+# concurrency - int requests to the route running at once
+# deadline - float seconds a request may take from arrival to response
+# queue - int requests allowed to wait for the route
+# rate, burst - float tokens per second and bucket size per client, None for no rate limit
+RouteLimit = namedtuple(
+    "RouteLimit",
+    ["priority", "concurrency", "deadline", "queue", "rate", "burst"],
+    defaults=(64, None, None),
+)
+
+
+class Rejected(Exception):
+    def __init__(self, status_code, reason, retry_after):
+        """
+        @param:
+        status_code - int 429 or 503
+        reason - str metric label
+        retry_after - float seconds the client should wait
+        """
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """
+        @return:
+        float - 0 if a token was taken, else seconds until one is available
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class Gate:
+    def __init__(self, route, limit):
+        self.route = route
+        self.limit = limit
+        self.priority = PRIORITIES.index(limit.priority)
+        self.active = 0
+        self.queued = 0
+        self.service = 0.0  # moving average of seconds from admission to response
+        self.admitted = 0
+        self.shed = 0
+
+
+class AdmissionController:
+    def __init__(self, limits, slots):
+        """
+        @param:
+        limits - dict route path template -> RouteLimit, other routes aren't limited
+        slots - int limited requests running at once across routes
+        """
+        self.gates = {route: Gate(route, limit) for route, limit in limits.items()}
+        self.slots = slots
+        self.active = 0
+        self.waiting = []  # heap of (priority, seq, gate, future)
+        self.seq = itertools.count()
+        self.buckets = LRUCache(BUCKETS_SIZE, ttl=None)  # (route, client) -> TokenBucket
+        self.sessions = {}  # client -> long lived connections open
+
+    def has_room(self, gate):
+        return self.active < self.slots and gate.active < gate.limit.concurrency
+
+    def expected_wait(self, gate):
+        """
+        @return:
+        float seconds before a request to the gate's route would be admitted,
+            from the service times of the waiters ahead of it
+        """
+        ahead = sum(
+            entry[2].service for entry in self.waiting
+            if entry[0] <= gate.priority and not entry[3].done()
+        )
+        wait = ahead / self.slots
+        if gate.active >= gate.limit.concurrency:
+            wait = max(wait, gate.service * (gate.queued + 1) / gate.limit.concurrency)
+        return wait
+
+    def rate_limit(self, gate, client):
+        if gate.limit.rate is None:
+            return
+        key = (gate.route, client)
+        bucket = self.buckets.get(key, count=False)
+        if bucket is None:
+            bucket = TokenBucket(gate.limit.rate, gate.limit.burst or gate.limit.rate)
+            self.buckets.put(key, bucket)
+        retry_after = bucket.take()
+        if retry_after:
+            raise Rejected(429, "rate_limited", retry_after)
+
+    def open_session(self, client, limit):
+        """
+        @param:
+        client - hashable key of the client
+        limit - int sessions a client may have open at once
+
+        @return:
+        bool - False if the client already has limit sessions open, the
+            session isn't counted then
+        """
+        if self.sessions.get(client, 0) >= limit:
+            return False
+        self.sessions[client] = self.sessions.get(client, 0) + 1
+        return True
+
+    def close_session(self, client):
+        self.sessions[client] -= 1
+        if not self.sessions[client]:
+            del self.sessions[client]
+
+    async def acquire(self, gate, client, arrived):
+        """
+        Wait for a slot for a request
+
+        @param:
+        client - hashable key of the client's token bucket
+        arrived - float time.monotonic() the request arrived at
+
+        @raise:
+        Rejected - the request has to be turned away
+        """
+        self.rate_limit(gate, client)
+        ahead = any(entry[0] <= gate.priority and not entry[3].done() for entry in self.waiting)
+        if not ahead and self.has_room(gate):
+            self.admit(gate)
+            ADMISSION_WAIT.observe(0.0, gate.route, gate.limit.priority)
+            return
+
+        if gate.queued >= gate.limit.queue:
+            raise Rejected(503, "queue_full", self.expected_wait(gate))
+        wait = self.expected_wait(gate)
+        budget = gate.limit.deadline - gate.service - (time.monotonic() - arrived)
+        if wait > budget:
+            raise Rejected(503, "deadline", wait)
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.waiting, (gate.priority, next(self.seq), gate, future))
+        gate.queued += 1
+        ADMISSION_QUEUED.set(gate.queued, gate.route)
+        # Waiters ahead may only be blocked by their own route's limit
+        self.dispatch()
+        try:
+            with phase("queue"):
+                await asyncio.wait_for(future, timeout=budget)
+        except asyncio.TimeoutError:
+            # Cancelled futures are skipped by dispatch, unless it got there first
+            if future.cancelled():
+                raise Rejected(503, "deadline", self.expected_wait(gate))
+        except BaseException:
+            # The client went away, give back a slot admitted meanwhile
+            if future.done() and not future.cancelled():
+                self.release(gate)
+            raise
+        finally:
+            gate.queued -= 1
+            ADMISSION_QUEUED.set(gate.queued, gate.route)
+            ADMISSION_WAIT.observe(time.monotonic() - arrived, gate.route, gate.limit.priority)
+            self.prune()
+
+    def prune(self):
+        # Drop timed out waiters once they outnumber the live ones
+        live = sum(gate.queued for gate in self.gates.values())
+        if len(self.waiting) > 2 * live + 16:
+            self.waiting = [entry for entry in self.waiting if not entry[3].done()]
+            heapq.heapify(self.waiting)
+
+    def admit(self, gate):
+        self.active += 1
+        gate.active += 1
+        gate.admitted += 1
+        ADMISSION_ACTIVE.set(gate.active, gate.route)
+
+    def release(self, gate, service=None):
+        """
+        @param:
+        service - float seconds the request ran after admission, None if it never ran
+        """
+        self.active -= 1
+        gate.active -= 1
+        ADMISSION_ACTIVE.set(gate.active, gate.route)
+        if service is not None:
+            gate.service += SERVICE_SMOOTHING * (service - gate.service)
+        self.dispatch()
+
+    def dispatch(self):
+        # Admit waiters in priority order while there are slots, skipping
+        # routes at their own limit
+        blocked = []
+        while self.waiting and self.active < self.slots:
+            entry = heapq.heappop(self.waiting)
+            gate, future = entry[2], entry[3]
+            if future.done():
+                continue
+            if gate.active >= gate.limit.concurrency:
+                blocked.append(entry)
+                continue
+            self.admit(gate)
+            future.set_result(None)
+        for entry in blocked:
+            heapq.heappush(self.waiting, entry)
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "slots": self.slots,
+            "waiting": sum(not entry[3].done() for entry in self.waiting),
+            "sessions": sum(self.sessions.values()),
+            "routes": {
+                route: {
+                    "active": gate.active,
+                    "queued": gate.queued,
+                    "admitted": gate.admitted,
+                    "shed": gate.shed,
+                    "service_seconds": gate.service,
+                }
+                for route, gate in self.gates.items()
+            },
+        }
+
+
+class AdmissionMiddleware:
+    def __init__(self, app, controller, router, client_key):
+        """
+        @param:
+        app - ASGI app
+        controller - AdmissionController
+        router - starlette Router the route path templates are matched against
+        client_key - callable ASGI scope -> hashable key for rate limiting
+        """
+        self.app = app
+        self.controller = controller
+        self.router = router
+        self.client_key = client_key
+
+    def route_of(self, scope):
+        for route in self.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, "path", None)
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        gate = self.controller.gates.get(self.route_of(scope))
+        if gate is None:
+            await self.app(scope, receive, send)
+            return
+
+        arrived = time.monotonic()
+        try:
+            await self.controller.acquire(gate, self.client_key(scope), arrived)
+        except Rejected as e:
+            gate.shed += 1
+            ADMISSION_SHED.inc(gate.route, e.reason)
+            response = JSONResponse(
+                status_code=e.status_code,
+                content={"detail": "Server busy, try again later" if e.status_code == 503 else "Too many requests"},
+                headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))},
+            )
+            await response(scope, receive, send)
+            return
+
+        admitted = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(gate, time.monotonic() - admitted)
@@ -0,0 +1,184 @@
+"""
+Approximate nearest critic search for large critic catalogs.
+
+Every metric in matching.py only counts the movies a critic shares with the
+user, so the critics worth scoring are the ones who rated the same kind of
+movies. Offline, the who-rated-what pattern of the review matrix, weighted
+by how rare each movie is (idf), is factored with a truncated SVD and the
+normalized critic embeddings are clustered with k-means into an inverted
+file (IVF) of critic lists.
+
+At query time the user's rated movies are summed into the same space, the
+lists whose centroids point the same way are probed, and only their critics
+are ranked exactly by CriticMatcher. Recall against exact search is measured
+by bench/bench_ann.py.
+"""
+import numpy as np
+
+from matching import expand_ranges
+
+
+# Arrays build_index adds to a model directory
+ANN_ARRAYS = ("ann_factors", "ann_centroids", "ann_list_indptr", "ann_list_critics")
+
+NPROBE = 8  # lists searched per query, doubled until enough critics qualify
+KMEANS_ITERATIONS = 25
+
+
+class CriticIndex:
+    def __init__(self, matcher, factors, centroids, list_indptr, list_critics, nprobe=NPROBE):
+        """
+        @param:
+        matcher - CriticMatcher the exact re-rank runs on
+        factors - float array movies x dim, idf weighted SVD movie factors
+        centroids - float array lists x dim, k-means centroids of critic embeddings
+        list_indptr, list_critics - critic rows of list i are
+            list_critics[list_indptr[i]:list_indptr[i + 1]]
+        nprobe - int lists searched per query
+        """
+        if len(factors) != matcher.num_movies or len(list_critics) != matcher.num_critics:
+            raise ValueError(
+                f"ANN index for {len(list_critics)} critics and {len(factors)} movies doesn't "
+                f"match a {matcher.num_critics} x {matcher.num_movies} model"
+            )
+        self.matcher = matcher
+        self.factors = factors
+        self.centroids = np.asarray(centroids, dtype=float)
+        self.list_indptr = list_indptr
+        self.list_critics = list_critics
+        self.nprobe = nprobe
+
+    @property
+    def num_lists(self):
+        return len(self.centroids)
+
+    def probe_order(self, user_prefs):
+        """
+        @return:
+        int array of list numbers, most promising first
+        """
+        rated = np.flatnonzero(~np.isnan(user_prefs))
+        embedding = np.asarray(self.factors[rated], dtype=float).sum(axis=0)
+        return np.argsort(-(self.centroids @ embedding), kind="stable")
+
+    def candidates(self, order, nprobe):
+        """
+        @return:
+        int array of the critic rows in the first nprobe lists of order
+        """
+        lists = order[:nprobe]
+        starts = self.list_indptr[lists]
+        counts = self.list_indptr[lists + 1] - starts
+        return np.sort(self.list_critics[expand_ranges(starts, counts)])
+
+    def top_critics(self, user_prefs, k, metric="sse", num_common=1):
+        """
+        Approximate CriticMatcher.top_critics, exact over the probed critics
+
+        @return:
+        list of Match, closest first
+        """
+        if k < 1 or np.isnan(user_prefs).all():
+            return []
+
+        order = self.probe_order(user_prefs)
+        nprobe = max(self.nprobe, 1)
+        while nprobe < self.num_lists:
+            critics = self.candidates(order, nprobe)
+            results = self.matcher.top_critics(user_prefs, k, metric, num_common, critics)
+            if len(results) >= k:
+                return results
+            nprobe *= 2
+        return self.matcher.top_critics(user_prefs, k, metric, num_common)
+
+    def closest_critic(self, user_prefs, num_common):
+        """
+        Approximate CriticMatcher.closest_critic
+
+        @return:
+        critic - int critic row, None if no critic has enough movies in common
+        matches - Overlap restricted to that critic, None if there is no critic
+        """
+        best = self.top_critics(user_prefs, 1, "sse", num_common)
+        if not best:
+            return None, None
+        return best[0].critic, best[0].matches
+
+
+def kmeans(points, k, rng, iterations=KMEANS_ITERATIONS):
+    """
+    Lloyd's k-means with k-means++ seeding
+
+    @return:
+    centroids - float array k x dim
+    labels - int array, the centroid of each point
+    """
+    centroids = [points[rng.integers(len(points))]]
+    closest = ((points - centroids[0]) ** 2).sum(axis=1)
+    for _ in range(1, k):
+        total = closest.sum()
+        pick = rng.choice(len(points), p=closest / total) if total > 0 else rng.integers(len(points))
+        centroids.append(points[pick])
+        closest = np.minimum(closest, ((points - points[pick]) ** 2).sum(axis=1))
+    centroids = np.array(centroids)
+
+    for _ in range(iterations):
+        distance = (
+            (points ** 2).sum(axis=1)[:, None]
+            - 2 * points @ centroids.T
+            + (centroids ** 2).sum(axis=1)[None, :]
+        )
+        labels = np.argmin(distance, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, points)
+        sizes = np.bincount(labels, minlength=k)
+        # Empty clusters keep their previous centroid
+        moved = sizes > 0
+        updated = centroids.copy()
+        updated[moved] = sums[moved] / sizes[moved, None]
+        if np.allclose(updated, centroids):
+            break
+        centroids = updated
+    return centroids, labels
+
+
+def build_index(matcher, dim=32, num_lists=None, seed=0):
+    """
+    Factor who rated what and cluster the critics, offline
+
+    @param:
+    matcher - CriticMatcher
+    dim - int embedding dimensions
+    num_lists - int IVF lists, about sqrt(#critics) if None
+
+    @return:
+    dict - ANN_ARRAYS name -> array, for model.save_ann
+    """
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.linalg import svds
+
+    csr = matcher.csr
+    coverage = np.diff(matcher.csc.indptr)
+    idf = np.log(matcher.num_critics / np.maximum(coverage, 1))
+    rated = csr_matrix(
+        (idf[csr.indices], csr.indices, csr.indptr),
+        shape=(matcher.num_critics, matcher.num_movies),
+    )
+    dim = min(dim, min(rated.shape) - 1)
+    rng = np.random.default_rng(seed)
+    u, s, vt = svds(rated, k=dim, v0=rng.standard_normal(min(rated.shape)))
+    embeddings = u * s
+    embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+    num_lists = num_lists or max(int(np.sqrt(matcher.num_critics)), 1)
+    centroids, labels = kmeans(embeddings, num_lists, rng)
+    list_critics = np.argsort(labels, kind="stable").astype(np.int32)
+    list_indptr = np.zeros(num_lists + 1, dtype=np.int64)
+    list_indptr[1:] = np.cumsum(np.bincount(labels, minlength=num_lists))
+    return {
+        # A user's embedding is then just the sum of their rated movies' rows
+        "ann_factors": (idf[:, None] * vt.T).astype(np.float32),
+        "ann_centroids": centroids.astype(np.float32),
+        "ann_list_indptr": list_indptr,
+        "ann_list_critics": list_critics,
+    }
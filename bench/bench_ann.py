@@ -0,0 +1,112 @@
+"""
+Measure recall and latency of approximate critic search against exact search.
+
+    python -m bench.bench_ann --model data/model --out bench_ann.json
+
+Needs an index built by build_ann_index.py. recall@k is the share of the
+exact top k critics the approximate search also returns. Queries are either
+synthetic users (noise around each movie's mean) or held out critics (a
+sample of one critic's ratings plus noise), which have a real taste to find.
+"""
+import argparse
+
+import numpy as np
+
+from bench.common import summarize, synthetic_ratings, time_calls, write_results
+from matching import UserPreferences
+from model import MODEL_PATH, load_model
+import main
+
+
+def held_out_ratings(model, count, rng, noise=5.0):
+    """
+    Ratings for a user who agrees with one critic, see synthetic_ratings
+    """
+    csr = model.matcher.csr
+    counts = np.diff(csr.indptr)
+    critic = rng.choice(np.flatnonzero(counts >= count))
+    positions = csr.indptr[critic] + rng.choice(counts[critic], size=count, replace=False)
+    ratings = np.clip(csr.data[positions] + rng.normal(0, noise, count), 0, 100).round()
+    return [
+        {"id": int(model.movie_ids[col]), "rating": float(rating)}
+        for col, rating in zip(csr.indices[positions], ratings)
+    ]
+
+
+QUERIES = {"synthetic": synthetic_ratings, "held_out": held_out_ratings}
+
+
+def recall(exact, approx):
+    exact = {match.critic for match in exact}
+    if not exact:
+        return 1.0
+    return len(exact & {match.critic for match in approx}) / len(exact)
+
+
+def bench_size(model, index, queries, size, users, k, metric, rng):
+    make_ratings = QUERIES[queries]
+    fields = {"queries": queries, "ratings": size, "k": k, "metric": metric}
+    queries = [
+        UserPreferences(model.matcher, model.movie_index, make_ratings(model, size, rng)).vec
+        for _ in range(users)
+    ]
+    exact = [model.matcher.top_critics(vec, k, metric, main.MIN_COMMON) for vec in queries]
+
+    results = [
+        summarize(
+            "exact",
+            [t for vec in queries for t in time_calls(lambda: model.matcher.top_critics(vec, k, metric, main.MIN_COMMON), 3)],
+            **fields,
+        )
+    ]
+    for nprobe in (1, 2, 4, 8, 16):
+        index.nprobe = nprobe
+        approx = [index.top_critics(vec, k, metric, main.MIN_COMMON) for vec in queries]
+        probed = [
+            len(index.candidates(index.probe_order(vec), nprobe)) / model.matcher.num_critics
+            for vec in queries
+        ]
+        latencies = [
+            t for vec in queries for t in time_calls(lambda: index.top_critics(vec, k, metric, main.MIN_COMMON), 3)
+        ]
+        results.append(
+            summarize(
+                f"approximate_nprobe{nprobe}",
+                latencies,
+                **fields,
+                recall_at_1=float(np.mean([recall(e[:1], a[:1]) for e, a in zip(exact, approx)])),
+                recall_at_k=float(np.mean([recall(e, a) for e, a in zip(exact, approx)])),
+                critics_probed=float(np.mean(probed)),
+            )
+        )
+    return results
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--queries", nargs="+", choices=list(QUERIES), default=list(QUERIES))
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--users", type=int, default=50, help="synthetic users per size")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--metric", default="sse")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="JSON output file, stdout if omitted")
+    args = parser.parse_args()
+
+    model = load_model(args.model)
+    if model.critic_index is None:
+        parser.error(f"{args.model} has no ANN index, run build_ann_index.py first")
+
+    rng = np.random.default_rng(args.seed)
+    results = []
+    for queries in args.queries:
+        for size in args.sizes:
+            results += bench_size(
+                model, model.critic_index, queries, size, args.users, args.k, args.metric, rng
+            )
+    write_results(results, args.out)
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,157 @@
+"""
+Load test the API routes in process, against the in-memory database.
+
+    python -m bench.bench_api --concurrency 32 --requests 2000 --out bench_api.json
+
+Requests go through the ASGI app with httpx (pip install httpx), so the
+numbers include routing, auth, validation and serialization but no socket
+overhead. --db-latency adds a simulated round trip to every database call.
+Ratings go through the write-behind queue, logged to a temporary file,
+unless --write-through is given. Admission control is off unless
+--admission is given, its rate limits would turn most requests away.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from datetime import timedelta
+
+import httpx
+import numpy as np
+
+from bench.common import summarize, synthetic_ratings, write_results
+from bench.fake_db import InMemoryCockroach
+from cache import RatingsCache
+from hashing import PasswordHasher
+from write_behind import RatingLog, RatingQueue
+import main
+
+
+PASSWORD = "benchmark"
+
+SCENARIOS = {
+    "rec_critic": ("GET", "/rec/critic", None),
+    "rec_critics": ("GET", "/rec/critics", {"k": 10, "metric": "pearson"}),
+    "rec_next": ("GET", "/rec/next", None),
+    "rec_movies": ("GET", "/rec/movies", {"n": 10, "critics": 3}),
+    "calibrated": ("GET", "/calibrated", None),
+    "rate": ("POST", "/rating/", None),
+    "login": ("POST", "/login", None),
+}
+
+
+def setup(num_users, num_ratings, db_latency, rng, log_path=None, admission=False):
+    """
+    Point the app at an in-memory database filled with synthetic users, on
+    the running loop
+
+    @param:
+    log_path - str write-behind log, None to write ratings through
+    admission - bool keep the app's admission control
+
+    @return:
+    list of (email, bearer token, rated movie ids)
+    """
+    model = main.model_registry.get()
+    db = InMemoryCockroach(db_latency)
+    main.db = db
+    if not admission:
+        main.admission.gates.clear()
+    queue = None
+    if log_path is not None:
+        queue = RatingQueue(db, RatingLog(log_path, main.RATING_LOG_FSYNC))
+        queue.start()
+    main.ratings_cache = RatingsCache(db, main.RATINGS_CACHE_SIZE, main.RATINGS_CACHE_TTL, queue)
+    # Cheap hashes keep /login about the request path rather than bcrypt cost
+    main.pwd_hasher = PasswordHasher(4, main.HASH_WORKERS, main.HASH_MAX_PENDING)
+    password_hash = main.pwd_hasher.context.hash(PASSWORD)
+
+    users = []
+    for i in range(num_users):
+        email = f"bench{i}@example.com"
+        ratings = synthetic_ratings(model, num_ratings, rng)
+        db.accounts[email] = password_hash
+        db.ratings[email] = {item["id"]: item["rating"] for item in ratings}
+        token = main.create_access_token({"sub": email}, timedelta(hours=1))
+        users.append((email, token, [item["id"] for item in ratings]))
+    return users
+
+
+def request_args(scenario, user, rng):
+    method, url, params = SCENARIOS[scenario]
+    email, token, movie_ids = user
+    kwargs = {"params": params, "headers": {"Authorization": f"Bearer {token}"}}
+    if scenario == "rate":
+        kwargs["params"] = {"movie_id": int(rng.choice(movie_ids)), "rating": float(rng.integers(0, 101))}
+    elif scenario == "login":
+        kwargs = {"data": {"username": email, "password": PASSWORD}}
+    return method, url, kwargs
+
+
+async def run_scenario(client, scenario, users, requests, concurrency, rng):
+    latencies = []
+    statuses = {}
+    remaining = iter(range(requests))
+
+    async def worker():
+        for i in remaining:
+            method, url, kwargs = request_args(scenario, users[i % len(users)], rng)
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - start
+    return summarize(
+        scenario,
+        latencies,
+        wall,
+        concurrency=concurrency,
+        statuses={str(code): count for code, count in sorted(statuses.items())},
+    )
+
+
+async def run(args):
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        log_path = None if args.write_through else os.path.join(tmp, "ratings.log")
+        users = setup(args.users, args.ratings, args.db_latency, rng, log_path, args.admission)
+        transport = httpx.ASGITransport(app=main.app)
+        results = []
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            for scenario in args.scenarios:
+                # Warm caches so every scenario measures the steady state
+                await run_scenario(client, scenario, users, len(users), 1, rng)
+                calls = main.db.calls
+                result = await run_scenario(client, scenario, users, args.requests, args.concurrency, rng)
+                # Flushes of the scenario's ratings count against it
+                await asyncio.sleep(main.RATING_FLUSH_DELAY * 4)
+                result["db_calls_per_request"] = (main.db.calls - calls) / args.requests
+                results.append(result)
+        if main.ratings_cache.queue is not None:
+            await main.ratings_cache.queue.close()
+    return results
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--ratings", type=int, default=100, help="ratings per synthetic user")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--db-latency", type=float, default=0.0, help="seconds per database call")
+    parser.add_argument("--write-through", action="store_true", help="wait for the database on every rating")
+    parser.add_argument("--admission", action="store_true", help="keep admission control and rate limits")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="JSON output file, stdout if omitted")
+    args = parser.parse_args()
+
+    write_results(asyncio.run(run(args)), args.out)
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,79 @@
+"""
+Benchmark the recommendation hot path on the real model artifacts.
+
+    python -m bench.bench_engine --out bench_output.json
+
+Synthetic users with 10, 100 and 1000 ratings are run through the same
+functions the routes call. Searches run with an empty match cache, their
+*_cache_hit cases with the result already cached.
+"""
+import argparse
+
+import numpy as np
+
+from bench.common import summarize, synthetic_ratings, time_calls, write_results
+from match_cache import MatchCache
+from matching import UserPreferences
+from model import MODEL_PATH, load_model
+import main
+
+
+def with_cache(cache, fn):
+    def run():
+        main.match_cache = cache
+        return fn()
+
+    return run
+
+
+def bench_user(model, ratings, repeat):
+    count = len(ratings)
+    prefs = UserPreferences(model.matcher, model.movie_index, ratings)
+    vec = prefs.vec
+    seen_ids = [item["id"] for item in ratings]
+    candidates = prefs.accumulator.candidates(main.CALIBRATION_CANDIDATES, main.MIN_COMMON)
+    new_rating = ratings[0]
+    # cold keeps nothing, so every lookup misses
+    cold, warm = MatchCache(0), MatchCache(16)
+
+    cases = {
+        "get_preference_vector": lambda: main.get_preference_vector(model, ratings),
+        "closest_critic": with_cache(cold, lambda: main.closest_critic(model, vec)),
+        "closest_critic_cache_hit": with_cache(warm, lambda: main.closest_critic(model, vec)),
+        "top_critics_k10_pearson": with_cache(cold, lambda: main.top_critics(model, vec, 10, "pearson")),
+        "top_critics_k10_pearson_cache_hit": with_cache(
+            warm, lambda: main.top_critics(model, vec, 10, "pearson")
+        ),
+        "user_preferences_build": lambda: UserPreferences(model.matcher, model.movie_index, ratings),
+        "accumulator_rate": lambda: prefs.rate(new_rating["id"], new_rating["rating"]),
+        "accumulator_closest": lambda: prefs.accumulator.closest_critic(main.MIN_COMMON),
+        "get_next": lambda: main.get_next(model, seen_ids, candidates),
+        "recommend_movies_3_critics": with_cache(
+            cold, lambda: main.recommend_movies(model, prefs, seen_ids, 10, 3)
+        ),
+    }
+    return [
+        summarize(name, time_calls(fn, repeat), ratings=count)
+        for name, fn in cases.items()
+    ]
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="JSON output file, stdout if omitted")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    model = load_model(args.model)
+    results = []
+    for size in args.sizes:
+        results += bench_user(model, synthetic_ratings(model, size, rng), args.repeat)
+    write_results(results, args.out)
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,132 @@
+"""
+Compare compact score storage against the float64 model: memory, matching
+latency and how far the results move.
+
+    python -m bench.bench_quantized --model data/model --out bench_quantized.json
+
+Each codec's model is written to a temporary directory with write_model and
+memory mapped like production. The limits the differences are held to are
+checked by tests/test_quantize.py.
+"""
+import argparse
+import os
+import tempfile
+
+import numpy as np
+
+from bench.common import summarize, synthetic_ratings, time_calls, write_results
+from matching import CriticAccumulator
+from model import MODEL_PATH, load_model, write_model
+import main
+
+
+CODECS = ("float16", "uint8")
+
+
+def model_bytes(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def exact_sse(matcher, critic, vec):
+    overlap = matcher.critic_overlap(critic, vec)
+    return float(((overlap.user_ratings - overlap.critic_ratings) ** 2).sum())
+
+
+def compare(exact, model, vecs, k):
+    """
+    @return:
+    dict - worst case differences of model's results from exact's:
+        decode - largest score error after a round trip
+        score, score_max - 99th percentile and largest pearson difference for
+            critics both top k lists share
+        closest_sse - largest relative SSE excess of the quantized closest
+            critic, scored exactly, over the exact closest critic
+        topk_overlap - mean share of the exact top k found by the quantized search
+    """
+    worst_sse, diffs, overlaps = 0.0, [], []
+    for vec in vecs:
+        best, _ = exact.matcher.closest_critic(vec, main.MIN_COMMON)
+        pick, _ = model.matcher.closest_critic(vec, main.MIN_COMMON)
+        if best is not None:
+            best_sse = exact_sse(exact.matcher, best, vec)
+            excess = exact_sse(exact.matcher, pick, vec) - best_sse
+            worst_sse = max(worst_sse, excess / max(best_sse, 1.0))
+
+        want = {m.critic: m.score for m in exact.matcher.top_critics(vec, k, "pearson", main.MIN_COMMON)}
+        got = {m.critic: m.score for m in model.matcher.top_critics(vec, k, "pearson", main.MIN_COMMON)}
+        shared = want.keys() & got.keys()
+        overlaps.append(len(shared) / len(want) if want else 1.0)
+        diffs += [abs(want[c] - got[c]) for c in shared]
+
+    decode = np.abs(
+        np.asarray(model.matcher.csr.data, dtype=float) - np.asarray(exact.matcher.csr.data)
+    ).max()
+    return {
+        "decode": float(decode),
+        "score": float(np.percentile(diffs, 99)) if diffs else 0.0,
+        "score_max": max(diffs, default=0.0),
+        "closest_sse": worst_sse,
+        "topk_overlap": float(np.mean(overlaps)),
+    }
+
+
+def bench_model(name, model, path, sizes, users, repeat, k, rng):
+    results = []
+    for size in sizes:
+        vecs = [
+            model.movie_index.preference_vector(synthetic_ratings(model, size, rng))[0]
+            for _ in range(users)
+        ]
+        cases = {
+            "closest_critic": lambda vec: model.matcher.closest_critic(vec, main.MIN_COMMON),
+            "top_critics_pearson": lambda vec: model.matcher.top_critics(vec, k, "pearson", main.MIN_COMMON),
+            "accumulator_build": lambda vec: CriticAccumulator(model.matcher, vec),
+        }
+        for case, fn in cases.items():
+            latencies = [t for vec in vecs for t in time_calls(lambda: fn(vec), repeat)]
+            results.append(
+                summarize(
+                    case,
+                    latencies,
+                    codec=name,
+                    ratings=size,
+                    score_bytes=model.matcher.csr.data.nbytes + model.matcher.csc.data.nbytes,
+                    model_bytes=model_bytes(path),
+                )
+            )
+    return results
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--users", type=int, default=20, help="synthetic users per size")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="JSON output file, stdout if omitted")
+    args = parser.parse_args()
+
+    exact = load_model(args.model)
+    results = bench_model("float64", exact, args.model, args.sizes, args.users, args.repeat, args.k, np.random.default_rng(args.seed))
+    with tempfile.TemporaryDirectory() as tmp:
+        for codec in CODECS:
+            path = os.path.join(tmp, codec)
+            write_model(path, exact.matcher, list(exact.critic_names), exact.movie_ids, codec)
+            model = load_model(path)
+            results += bench_model(codec, model, path, args.sizes, args.users, args.repeat, args.k, np.random.default_rng(args.seed))
+
+            rng = np.random.default_rng(args.seed)
+            vecs = [
+                exact.movie_index.preference_vector(synthetic_ratings(exact, size, rng))[0]
+                for size in args.sizes
+                for _ in range(args.users)
+            ]
+            results.append({"name": "accuracy", "codec": codec, **compare(exact, model, vecs, args.k)})
+
+    write_results(results, args.out)
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,87 @@
+"""
+Shared helpers for the benchmark scripts: synthetic users, timing and
+machine-readable output.
+"""
+import json
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def synthetic_ratings(model, count, rng):
+    """
+    Ratings for a synthetic user, favouring movies many critics reviewed
+
+    @param:
+    model - model.Model
+    count - int number of distinct movies rated
+    rng - np.random.Generator
+
+    @return:
+    list of dicts [{id, rating}] like Cockroach.pull_ratings
+    """
+    coverage = np.diff(model.matcher.csc.indptr).astype(float)
+    cols = rng.choice(len(coverage), size=count, replace=False, p=coverage / coverage.sum())
+    ratings = np.clip(model.calibrator.means[cols] + rng.normal(0, 15, count), 0, 100).round()
+    return [
+        {"id": int(model.movie_ids[col]), "rating": float(rating)}
+        for col, rating in zip(cols, ratings)
+    ]
+
+
+def summarize(name, latencies, wall=None, **fields):
+    """
+    @param:
+    latencies - list of float seconds per operation
+    wall - float seconds the operations took end to end, sum of latencies if None
+
+    @return:
+    dict - latency percentiles in milliseconds and throughput
+    """
+    latencies = np.asarray(latencies)
+    wall = latencies.sum() if wall is None else wall
+    return {
+        "name": name,
+        **fields,
+        "count": len(latencies),
+        "mean_ms": float(latencies.mean() * 1000),
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p90_ms": float(np.percentile(latencies, 90) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "max_ms": float(latencies.max() * 1000),
+        "ops_per_sec": float(len(latencies) / wall) if wall else None,
+    }
+
+
+def time_calls(fn, repeat):
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def write_results(results, out=None):
+    """
+    Write results as JSON with enough context to compare runs between commits
+    """
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    report = {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if out:
+        with open(out, "w") as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
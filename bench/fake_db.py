@@ -0,0 +1,72 @@
+"""
+In-memory stand-in for cockroach.Cockroach, so the API can be exercised
+locally without the remote cluster.
+"""
+import asyncio
+
+
+class InMemoryCockroach:
+    def __init__(self, latency=0.0):
+        """
+        @param:
+        latency - float seconds each call sleeps, to mimic a network round trip
+        """
+        self.latency = latency
+        self.accounts = {}  # email -> hash
+        self.ratings = {}  # email -> {movie: rating}
+        self.pool = self
+        self.calls = 0
+
+    async def _round_trip(self):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+
+    async def connect(self):
+        return self.pool
+
+    async def close(self):
+        pass
+
+    async def add_account(self, email, password_hash):
+        await self._round_trip()
+        if email in self.accounts:
+            return False
+        self.accounts[email] = password_hash
+        return True
+
+    async def get_auth(self, email):
+        await self._round_trip()
+        return self.accounts.get(email)
+
+    async def send_rating(self, email, movie, rating):
+        return await self.send_ratings(email, [(movie, rating)])
+
+    async def send_ratings(self, email, ratings):
+        await self._round_trip()
+        user = self.ratings.setdefault(email, {})
+        for movie, rating in ratings:
+            user[int(movie)] = float(rating)
+        return True
+
+    async def send_ratings_batch(self, rows):
+        await self._round_trip()
+        for email, movie, rating in rows:
+            self.ratings.setdefault(email, {})[int(movie)] = float(rating)
+        return True
+
+    async def pull_ratings(self, email):
+        await self._round_trip()
+        return [
+            {"id": movie, "rating": rating}
+            for movie, rating in self.ratings.get(email, {}).items()
+        ]
+
+    async def del_ratings(self, email):
+        await self._round_trip()
+        self.ratings.pop(email, None)
+        return True
+
+    async def stream_ratings(self, prefetch=10000):
+        for email in sorted(self.ratings):
+            for movie, rating in self.ratings[email].items():
+                yield email, str(movie), rating
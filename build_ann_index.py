@@ -0,0 +1,37 @@
+"""
+Build the approximate critic search index into a model directory, for
+MATCH_MODE = "approximate".
+
+    python build_ann_index.py --model data/model --dim 32
+
+Recall against exact search is measured by bench/bench_ann.py.
+"""
+import argparse
+import time
+
+from ann import build_index
+from model import MODEL_PATH, load_model, save_ann
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--dim", type=int, default=32, help="embedding dimensions")
+    parser.add_argument("--lists", type=int, help="IVF lists, about sqrt(#critics) by default")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    model = load_model(args.model)
+    start = time.perf_counter()
+    arrays = build_index(model.matcher, args.dim, args.lists, args.seed)
+    save_ann(args.model, arrays)
+
+    sizes = arrays["ann_list_indptr"][1:] - arrays["ann_list_indptr"][:-1]
+    print(
+        f"Built {arrays['ann_factors'].shape[1]}-d index with {len(sizes)} lists "
+        f"({sizes.min()}-{sizes.max()} critics each) in {time.perf_counter() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Export critic review text from Cloud SQL into a model directory, so critic
+profiles can be served without a database round trip.
+
+    python build_review_store.py --model data/model
+"""
+import argparse
+
+import numpy as np
+
+from gcpsql import GCP
+from model import MODEL_PATH, load_model, save_reviews
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default=MODEL_PATH)
+    args = parser.parse_args()
+
+    model = load_model(args.model)
+    csr = model.matcher.csr
+    rows = model.critic_store.rows
+    texts = [""] * len(csr.data)
+
+    found = missing = 0
+    for critic, movie, review in GCP().iter_reviews():
+        row = rows.get(critic)
+        if row is None:
+            missing += 1
+            continue
+
+        start, end = csr.indptr[row], csr.indptr[row + 1]
+        matched = False
+        for col in model.movie_index.lookup([int(movie)]).cols:
+            # Rows are sorted by column, so the entry is found by bisection
+            position = start + np.searchsorted(csr.indices[start:end], col)
+            if position < end and csr.indices[position] == col:
+                texts[position] = review or ""
+                matched = True
+        found += matched
+        missing += not matched
+
+    save_reviews(args.model, texts)
+    print(f"Stored {found} reviews, {missing} had no rating in the model")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+In-process caches that keep the remote database off the read path.
+"""
+import time
+from collections import OrderedDict
+
+
+# Pulls repeated when a flush of queued ratings lands while they run
+PULL_ATTEMPTS = 3
+
+
+class LRUCache:
+    def __init__(self, maxsize, ttl=None):
+        """
+        @param:
+        maxsize - int maximum number of entries, least recently used are evicted
+        ttl - float seconds an entry stays valid, None to never expire
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires, value)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None, count=True):
+        item = self.entries.get(key)
+        if item is not None:
+            expires, value = item
+            if expires is None or expires > time.monotonic():
+                self.entries.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return value
+            del self.entries[key]
+        if count:
+            self.misses += 1
+        return default
+
+    def put(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        item = self.entries.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class UserRatings:
+    def __init__(self, ratings):
+        """
+        @param:
+        ratings - list of dicts [{id, rating}] as returned by Cockroach.pull_ratings
+        """
+        self.ratings = ratings
+        # Derived preference state with a rate(movie, rating) method, built on first use
+        self.prefs = None
+        # Fingerprint of the model prefs was built against, it is rebuilt after a reload
+        self.prefs_fingerprint = None
+
+
+def merge_ratings(ratings, latest):
+    """
+    @param:
+    ratings - list of dicts [{id, rating}]
+    latest - dict movie -> rating replacing or adding to them
+
+    @return:
+    new list of dicts, ratings is left as is
+    """
+    if not latest:
+        return ratings
+    return [item for item in ratings if item["id"] not in latest] + [
+        {"id": movie, "rating": rating} for movie, rating in latest.items()
+    ]
+
+
+class RatingsCache:
+    def __init__(self, db, maxsize, ttl, queue=None):
+        """
+        Cache of user ratings in front of a Cockroach instance, written
+        through or, with a queue, behind
+
+        @param:
+        db - Cockroach
+        maxsize - int maximum number of cached users
+        ttl - float seconds before a user's ratings are pulled again
+        queue - write_behind.RatingQueue writes are acknowledged from, None
+            to wait for the database
+        """
+        self.db = db
+        self.queue = queue
+        self.cache = LRUCache(maxsize, ttl)
+        # Bumped around every write, a pull that raced a write is not cached
+        self.write_seq = 0
+
+    async def entry(self, email):
+        """
+        Get the cached ratings for a user, pulling them on a miss
+
+        @return:
+        UserRatings, None if the ratings couldn't be pulled
+        """
+        entry = self.cache.get(email)
+        if entry is not None:
+            return entry
+
+        write_seq = self.write_seq
+        ratings = await self.pull_with_pending(email)
+        if ratings is None:
+            return None
+        entry = UserRatings(ratings)
+        if write_seq == self.write_seq:
+            self.cache.put(email, entry)
+        return entry
+
+    async def pull_with_pending(self, email):
+        """
+        Pull a user's ratings with their queued ratings applied, so users
+        read their own writes before they are flushed
+        """
+        if self.queue is None:
+            return await self.db.pull_ratings(email)
+        for _ in range(PULL_ATTEMPTS):
+            flushes = self.queue.flushes
+            ratings = await self.db.pull_ratings(email)
+            # Flushed meanwhile, the pull may have missed ratings no longer pending
+            if ratings is None or flushes == self.queue.flushes:
+                break
+        if ratings is None:
+            return None
+        return merge_ratings(ratings, self.queue.user_ratings(email))
+
+    async def pull_ratings(self, email):
+        entry = await self.entry(email)
+        return None if entry is None else entry.ratings
+
+    async def send_rating(self, email, movie, rating):
+        return await self.send_ratings(email, [(movie, rating)])
+
+    async def send_ratings(self, email, ratings, held=None):
+        """
+        Upsert or queue ratings and apply them to the cached entry
+
+        @param:
+        email - str user email
+        ratings - list of (movie, rating) pairs, later pairs for a movie win
+        held - UserRatings a long lived caller keeps, updated too if it was
+            evicted from the cache meanwhile
+        """
+        self.write_seq += 1
+        if self.queue is None:
+            succ = await self.db.send_ratings(email, ratings)
+        else:
+            succ = await self.queue.put(email, ratings)
+        self.write_seq += 1
+
+        entry = self.cache.get(email, count=False)
+        if not succ:
+            if entry is not None:
+                self.cache.pop(email)
+            return succ
+
+        latest = {int(movie): float(rating) for movie, rating in ratings}
+        for target in {id(e): e for e in (entry, held) if e is not None}.values():
+            # Replace rather than mutate, callers may still hold the old list
+            target.ratings = merge_ratings(target.ratings, latest)
+            if target.prefs is not None:
+                for movie, rating in latest.items():
+                    target.prefs.rate(movie, rating)
+        return succ
+
+    async def del_ratings(self, email):
+        """
+        @return:
+        bool - success, nothing is deleted if queued ratings couldn't be dropped
+        """
+        self.write_seq += 1
+        if self.queue is not None and not await self.queue.discard(email):
+            self.write_seq += 1
+            return False
+        succ = await self.db.del_ratings(email)
+        self.write_seq += 1
+        # Dropped either way, a failed delete may have removed some ratings
+        self.cache.pop(email)
+        return succ
+
+    def stats(self):
+        stats = self.cache.stats()
+        if self.queue is not None:
+            stats["write_behind"] = self.queue.stats()
+        return stats
@@ -0,0 +1,92 @@
+"""
+Picking the next movie for a user to rate while calibrating.
+
+Movies that many critics rated, and rated very differently, say the most
+about which critic a user agrees with. A pool of those is ranked once per
+model; each pick then favours the movie that best splits the user's
+current candidate critics.
+"""
+import numpy as np
+
+from matching import column_entries
+
+
+POOL_SIZE = 100
+
+
+class Calibrator:
+    def __init__(self, matcher, movie_ids, pool_size=POOL_SIZE):
+        """
+        @param:
+        matcher - CriticMatcher
+        movie_ids - int array of TMDB ids, one per movie column
+        pool_size - int number of most discriminating movies considered per pick
+        """
+        self.matcher = matcher
+        self.movie_ids = np.asarray(movie_ids, dtype=np.int64)
+
+        csc = matcher.csc
+        coverage = np.diff(csc.indptr)
+        cols = np.repeat(np.arange(len(coverage)), coverage)
+        data = np.asarray(csc.data, dtype=float)
+        total = np.bincount(cols, weights=data, minlength=len(coverage))
+        total_sq = np.bincount(cols, weights=data ** 2, minlength=len(coverage))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.means = np.nan_to_num(total / coverage)
+            variance = np.maximum(np.nan_to_num(total_sq / coverage) - self.means ** 2, 0.0)
+
+        # Every column ranked by coverage * variance, the first column of a
+        # duplicated movie id stands for it
+        order = np.argsort(-(coverage * variance), kind="stable")
+        _, first = np.unique(self.movie_ids[order], return_index=True)
+        self.ranked = order[np.sort(first)]
+        self.pool = self.ranked[:pool_size]
+        self.pool_positions, self.pool_counts = column_entries(csc.indptr, self.pool)
+
+    def next_movie(self, seen_ids=(), candidates=None):
+        """
+        Pick the next movie to rate
+
+        @param:
+        seen_ids - int array of TMDB ids the user already rated
+        candidates - int array of critic rows still in contention, None for all critics
+
+        @return:
+        (movie_id, avg_rating) - int TMDB id and mean critic rating rounded to an
+            int, None if the user has rated every movie
+        """
+        seen_ids = np.asarray(seen_ids, dtype=np.int64)
+        unseen = ~np.isin(self.movie_ids[self.pool], seen_ids)
+        if not unseen.any():
+            return self._fallback(seen_ids)
+
+        # Coverage * variance among the candidates, for every pool movie at once
+        csc = self.matcher.csc
+        critics = csc.indices[self.pool_positions]
+        ratings = csc.data[self.pool_positions]
+        slots = np.repeat(np.arange(len(self.pool)), self.pool_counts)
+        weights = np.ones(len(critics))
+        if candidates is not None:
+            is_candidate = np.zeros(self.matcher.num_critics, dtype=bool)
+            is_candidate[candidates] = True
+            weights = is_candidate[critics].astype(float)
+
+        coverage = np.bincount(slots, weights=weights, minlength=len(self.pool))
+        total = np.bincount(slots, weights=weights * ratings, minlength=len(self.pool))
+        total_sq = np.bincount(slots, weights=weights * ratings ** 2, minlength=len(self.pool))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.nan_to_num(total / coverage)
+            variance = np.maximum(np.nan_to_num(total_sq / coverage) - mean ** 2, 0.0)
+
+        # Ties, e.g. no candidate rated any unseen movie, go to the global ranking
+        gain = np.where(unseen, coverage * variance, -1.0)
+        return self._pick(self.pool[int(np.argmax(gain))])
+
+    def _fallback(self, seen_ids):
+        unseen = np.flatnonzero(~np.isin(self.movie_ids[self.ranked], seen_ids))
+        if len(unseen) == 0:
+            return None
+        return self._pick(self.ranked[unseen[0]])
+
+    def _pick(self, col):
+        return int(self.movie_ids[col]), int(round(self.means[col]))
@@ -0,0 +1,36 @@
+"""
+Convert the legacy .npz/.npy artifacts into a memory-mappable model directory.
+
+    python convert_model.py --ratings data/sparse_ratings.npz \
+        --critics data/critics.npy --movies data/tmdb_ids.npy --out data/model
+"""
+import argparse
+
+import numpy as np
+from scipy.sparse import load_npz
+
+from model import MODEL_PATH, load_model, save_model
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--ratings", default="data/sparse_ratings.npz")
+    parser.add_argument("--critics", default="data/critics.npy")
+    parser.add_argument("--movies", default="data/tmdb_ids.npy")
+    parser.add_argument("--out", default=MODEL_PATH)
+    args = parser.parse_args()
+
+    review_mtx = load_npz(args.ratings)
+    critic_map = np.load(args.critics, allow_pickle=True)
+    movie_ids = np.load(args.movies, allow_pickle=True)
+    save_model(args.out, review_mtx, critic_map, movie_ids)
+
+    # Read it back to make sure the written model is consistent
+    model = load_model(args.out)
+    assert list(model.critic_names) == [str(name) for name in critic_map]
+    assert np.array_equal(model.movie_ids, movie_ids)
+    print(f"Wrote {args.out}: {model.shape[0]} critics x {model.shape[1]} movies")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Critic profiles served from the local model instead of Cloud SQL.
+
+Scores come straight from the critic's CSR row. Review text, when the model
+directory has it, lives in a memory-mapped string table aligned with the
+CSR entries, so entry i of the matrix has review text i.
+"""
+import numpy as np
+
+
+SORTS = ("score_desc", "score_asc", "movie")
+
+
+class CriticStore:
+    def __init__(self, matcher, movie_ids, critic_names, score_order, means, reviews=None):
+        """
+        @param:
+        matcher - CriticMatcher
+        movie_ids - int array of TMDB ids, one per movie column
+        critic_names - StringTable, one name per critic row
+        score_order - int array of CSR entry positions, each row best score first
+        means - float array of each critic's mean score
+        reviews - StringTable of review text per CSR entry, None if not built
+        """
+        self.matcher = matcher
+        self.means = means
+        self.movie_ids = movie_ids
+        self.score_order = score_order
+        self.reviews = reviews
+        self.rows = {name: row for row, name in enumerate(critic_names)}
+
+    def profile(self, name, offset=0, limit=50, sort="score_desc"):
+        """
+        Get a page of a critic's reviews
+
+        @param:
+        name - str critic name
+        offset, limit - int page of reviews returned
+        sort - str one of SORTS
+
+        @return:
+        dict - {critic_id, num_reviews, mean_score, reviews: [{movie_id, score, review}]},
+            None if there is no critic with that name
+        """
+        if sort not in SORTS:
+            raise ValueError(f"Unknown sort {sort}")
+        row = self.rows.get(name)
+        if row is None:
+            return None
+
+        csr = self.matcher.csr
+        start, end = csr.indptr[row], csr.indptr[row + 1]
+        if sort == "movie":
+            positions = start + np.argsort(self.movie_ids[csr.indices[start:end]], kind="stable")
+        else:
+            positions = self.score_order[start:end]
+            if sort == "score_asc":
+                positions = positions[::-1]
+        page = positions[offset : offset + limit]
+
+        return {
+            "critic_id": name,
+            "num_reviews": int(end - start),
+            "mean_score": float(self.means[row]) if end > start else None,
+            "reviews": [
+                {
+                    "movie_id": int(self.movie_ids[csr.indices[position]]),
+                    "score": float(csr.data[position]),
+                    "review": (self.reviews[position] or None) if self.reviews is not None else None,
+                }
+                for position in page
+            ],
+        }
@@ -73,15 +73,15 @@ class GCP:
         rating - float score 0-100
         review - str review
         '''
-        plan_name = 'get_review'
         try:
             with self.pool.connect() as conn:
-                conn.execute(
-                f"PREPARE {plan_name} (text, text) AS SELECT rating, review FROM {self.critic_ratings} WHERE movieid=$1 AND criticid=$2; \
-                EXECUTE {plan_name}('{movie}', '{critic}');"
-            )
-                rows = conn.fetchall()
-                conn.execute(f"DEALLOCATE {plan_name}")
+                rows = conn.execute(
+                    sqlalchemy.text(
+                        f"SELECT rating, review FROM {self.critic_ratings} WHERE movieid=:movie AND criticid=:critic"
+                    ),
+                    movie=str(movie),
+                    critic=critic,
+                ).fetchall()
             
             return (float(rows[0][0]), rows[0][1])
         except Exception as e:
@@ -99,16 +99,37 @@ class GCP:
         @return:
         reviews - list of dicts containing movie names and ratings [{moveid, rating, review}]
         '''
-        plan_name = 'get_critic'
         try:
             with self.pool.connect() as conn:
-                conn.execute(
-                f"PREPARE {plan_name} (text) AS SELECT movieid, rating, review FROM {self.critic_ratings} WHERE criticid=$1; \
-                EXECUTE {plan_name}('{critic}');"
-            )
-                rows = conn.fetchall()
-                conn.execute(f"DEALLOCATE {plan_name}")
+                rows = conn.execute(
+                    sqlalchemy.text(
+                        f"SELECT movieid, rating, review FROM {self.critic_ratings} WHERE criticid=:critic"
+                    ),
+                    critic=critic,
+                ).fetchall()
             return [{'id': item[0], 'rating': float(item[1]), 'review': item[2]} for item in rows]
         except Exception as e:
             print("ERROR [gcp get critic]:", e)
             return None
+
+
+    def iter_reviews(self, chunk_size=10000):
+        '''
+        Stream every critic review with a server-side cursor
+
+        @param:
+        chunk_size - int rows fetched per round trip
+
+        @return:
+        generator of (criticid, movieid, review) tuples
+        '''
+        with self.pool.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(
+                sqlalchemy.text(f"SELECT criticid, movieid, review FROM {self.critic_ratings}")
+            )
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row[0], row[1], row[2]
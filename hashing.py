@@ -0,0 +1,87 @@
+"""
+Password hashing off the event loop.
+
+bcrypt is deliberately slow, so hashes and verifications run on a bounded
+thread pool (the bcrypt C extension releases the GIL) instead of stalling
+every other request in flight.
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from passlib.context import CryptContext
+
+
+class HasherBusy(Exception):
+    """Raised when too many hashes are already waiting"""
+
+
+class PasswordHasher:
+    def __init__(self, rounds, workers, max_pending):
+        """
+        @param:
+        rounds - int bcrypt cost for new hashes, existing hashes keep theirs
+        workers - int number of hashing threads
+        max_pending - int hashes allowed to queue or run before callers are refused
+        """
+        self.context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=rounds)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.max_pending = max_pending
+
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    async def verify(self, plain_password, hashed_password):
+        return await self._run(self.context.verify, plain_password, hashed_password)
+
+    async def hash(self, password):
+        return await self._run(self.context.hash, password)
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HasherBusy(f"{self.pending} password hashes pending")
+
+        self.pending += 1
+        submitted = time.monotonic()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(
+                self.executor, self._timed, submitted, fn, *args
+            )
+        finally:
+            self.pending -= 1
+
+    def _timed(self, submitted, fn, *args):
+        start = time.monotonic()
+        with self.lock:
+            self.running += 1
+            self.total_wait += start - submitted
+        try:
+            return fn(*args)
+        finally:
+            latency = time.monotonic() - start
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+    def stats(self):
+        with self.lock:
+            completed = self.completed
+            return {
+                "queued": self.pending - self.running,
+                "running": self.running,
+                "completed": completed,
+                "rejected": self.rejected,
+                "wait_avg": self.total_wait / completed if completed else 0.0,
+                "latency_avg": self.total_latency / completed if completed else 0.0,
+                "latency_max": self.max_latency,
+            }
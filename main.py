@@ -1,21 +1,37 @@
 #from gcpsql import GCP
 from typing import Optional, List
+import asyncio
+import hmac
+import json
+import math
+import os
 from datetime import datetime, timedelta
-import random
 import numpy as np
-from scipy.sparse import csr_matrix, load_npz
 from urllib.parse import unquote
 
-from fastapi import Depends, FastAPI, HTTPException, status
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, WebSocket, WebSocketDisconnect, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
 
 from pydantic import BaseModel
-from starlette.responses import RedirectResponse
-from jose import JWTError, jwt
-from passlib.context import CryptContext
+from starlette.responses import JSONResponse, PlainTextResponse, RedirectResponse
+from jose import jwt
 
+from admission import AdmissionController, AdmissionMiddleware, Rejected, RouteLimit
+from cache import RatingsCache
 from cockroach import Cockroach
+from critics import SORTS
+from hashing import HasherBusy, PasswordHasher
+from match_cache import MatchCache
+from matching import METRICS, UserPreferences
+import metrics
+from metrics import MetricsMiddleware, TimedRoute, phase, report_error, timed
+from model import MODEL_PATH, Model
+from profiler import SamplingProfiler
+from registry import ModelRegistry, ModelVersionMiddleware
+from startup import Startup
+from tokens import TokenVerifier
+from write_behind import LogLocked, RatingLog, RatingQueue
 
 
 sample_reviews = {
@@ -40,9 +56,77 @@ SECRET_KEY = "454d65c011f30bba0811c14000148859eef72a8bdeb45ff2570becc3178dccd3"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 1440
 
+# /metrics, /stats and /profiles want "Authorization: Bearer <token>" and
+# requests are profiled when sent with "X-Profile: <token>", all of them are
+# off without a token
+ADMIN_TOKEN = os.environ.get("CINETRICS_ADMIN_TOKEN")
+
 # Site parameters
 CALIBRATION_COUNT = 10
 MIN_COMMON = 3
+MAX_CRITICS = 50
+MAX_MOVIES = 100
+MAX_REVIEWS = 200
+MAX_BATCH_RATINGS = 500
+MAX_RATING = 100
+UNSEEN_RATING = -1  # rating a client sends for a movie the user hasn't seen
+CALIBRATION_IDLE_TIMEOUT = 600  # seconds a calibration session waits for a rating
+CALIBRATION_SESSIONS = 2  # calibration sessions a user may have open at once
+CALIBRATION_CANDIDATES = 50
+# "exact" ranks every critic, "approximate" only the ones the model's ANN
+# index (build_ann_index.py) probes, falling back to exact without an index
+MATCH_MODE = "exact"
+
+# Password hashing parameters
+BCRYPT_ROUNDS = 12
+HASH_WORKERS = 2
+HASH_MAX_PENDING = 32
+
+# Model parameters
+MODEL_POLL_INTERVAL = 30  # seconds between checks for a new model version
+
+# Cache parameters
+RATINGS_CACHE_SIZE = 10000
+RATINGS_CACHE_TTL = 300  # seconds
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 300  # seconds
+MATCH_CACHE_SIZE = 10000
+MATCH_CACHE_PATH = None  # SQLite file shared by the workers on a host, None for memory only
+MATCH_CACHE_DISK_SIZE = 100000
+
+# Write-behind parameters
+# Ratings are acknowledged once logged here and flushed to the database in
+# batches, None to wait for the database instead. The log has to outlive the
+# process, which App Engine's memory backed /tmp doesn't, and is locked by
+# the process using it, other workers write through
+RATING_LOG_PATH = None
+RATING_LOG_FSYNC = True
+RATING_FLUSH_DELAY = 0.05  # seconds a flush waits for more ratings
+RATING_FLUSH_BATCH = 500
+
+# Admission parameters
+ADMISSION_SLOTS = 32  # limited requests running at once across routes
+# Route path template -> RouteLimit(priority, concurrency, deadline seconds,
+# queue, rate per second and burst per user or address), "read" routes are
+# admitted ahead of "heavy" ones and other routes aren't limited
+ADMISSION_LIMITS = {
+    "/calibrated": RouteLimit("read", 16, 1.0),
+    "/ratings": RouteLimit("read", 16, 1.0),
+    "/rec/next": RouteLimit("read", 16, 1.0),
+    "/critic/{critic_id}": RouteLimit("read", 16, 1.0),
+    "/rating/": RouteLimit("read", 16, 1.0, rate=10, burst=30),
+    "/ratings/batch": RouteLimit("heavy", 4, 5.0, rate=1, burst=5),
+    "/rec/critic": RouteLimit("heavy", 4, 2.0, rate=5, burst=20),
+    "/rec/critics": RouteLimit("heavy", 4, 2.0, rate=5, burst=20),
+    "/rec/movies": RouteLimit("heavy", 4, 2.0, rate=5, burst=20),
+    "/login": RouteLimit("heavy", 2 * HASH_WORKERS, 5.0, queue=HASH_MAX_PENDING, rate=0.2, burst=10),
+    "/register": RouteLimit("heavy", HASH_WORKERS, 5.0, queue=HASH_MAX_PENDING, rate=0.05, burst=3),
+}
+# Header holding an anonymous client's address for rate limiting. Behind App
+# Engine every request arrives from a front end address, so the client's is
+# taken from the header App Engine sets, which it strips from incoming
+# requests. Only trust it there, None keys on the connecting address
+ADMISSION_CLIENT_HEADER = b"x-appengine-user-ip"
 
 
 class Token(BaseModel):
@@ -64,17 +148,102 @@ class UserInDB(User):
     hashed_password: str
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+def valid_rating(rating):
+    # float() takes NaN and Infinity, which would poison the critic distances
+    return 0 <= rating <= MAX_RATING or rating == UNSEEN_RATING
+
+
+RATING_RANGE = f"rating must be between 0 and {MAX_RATING}, or {UNSEEN_RATING} if unseen"
+
+
+class Rating(BaseModel):
+    movie_id: int
+    rating: float
+
+    @property
+    def valid(self):
+        return valid_rating(self.rating)
+
+
+pwd_hasher = PasswordHasher(BCRYPT_ROUNDS, HASH_WORKERS, HASH_MAX_PENDING)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+startup = Startup()
+model_registry = ModelRegistry(MODEL_PATH, startup)
 db = Cockroach()
+rating_queue = None
+if RATING_LOG_PATH is not None:
+    rating_queue = RatingQueue(
+        db,
+        RatingLog(RATING_LOG_PATH, RATING_LOG_FSYNC),
+        delay=RATING_FLUSH_DELAY,
+        batch=RATING_FLUSH_BATCH,
+    )
+ratings_cache = RatingsCache(db, RATINGS_CACHE_SIZE, RATINGS_CACHE_TTL, rating_queue)
+match_cache = MatchCache(MATCH_CACHE_SIZE, MATCH_CACHE_PATH, MATCH_CACHE_DISK_SIZE)
+admission = AdmissionController(ADMISSION_LIMITS, ADMISSION_SLOTS)
 app = FastAPI()
+app.router.route_class = TimedRoute
+profiler = SamplingProfiler(ADMIN_TOKEN)
 # try:
 #     gcp = GCP()
 # except Exception as e:
 #     print("ERROR: ", e)
 
+
+@app.on_event("startup")
+async def warm_up():
+    # Load the model and open the pool in the background, so routes that
+    # don't need them can serve right away
+    if rating_queue is not None:
+        # Before any read, so users see ratings queued before a restart
+        try:
+            rating_queue.start()
+        except (LogLocked, OSError) as e:
+            report_error("rating_log", "start", e)
+            ratings_cache.queue = None
+    asyncio.get_event_loop().run_in_executor(None, model_registry.get)
+    asyncio.ensure_future(model_registry.watch(MODEL_POLL_INTERVAL))
+    asyncio.ensure_future(connect_db())
+
+
+async def connect_db():
+    try:
+        with startup.phase("db_pool"):
+            await db.connect()
+    except Exception as e:
+        report_error("db", "connect", e)
+
+
+@app.on_event("shutdown")
+async def close_db():
+    if rating_queue is not None:
+        await rating_queue.close()
+    await db.close()
+
+
+
+def admission_client(scope):
+    # Rate limit users by their token's subject, anonymous requests by address
+    address = None
+    for name, value in scope.get("headers", []):
+        if name == b"authorization" and value[:7].lower() == b"bearer ":
+            claims = token_verifier.decode(value[7:].decode("latin-1"))
+            if claims is not None and claims.get("sub"):
+                return claims["sub"]
+        elif ADMISSION_CLIENT_HEADER is not None and name == ADMISSION_CLIENT_HEADER:
+            address = value.decode("latin-1").strip()
+    if address:
+        return address
+    client = scope.get("client")
+    return client[0] if client else None
+
+
+# Innermost, so shed requests still get CORS headers and are counted in metrics
+app.add_middleware(
+    AdmissionMiddleware, controller=admission, router=app.router, client_key=admission_client
+)
 # CORS Policy
 app.add_middleware(
     CORSMiddleware,
@@ -83,32 +252,52 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware, profiler=profiler)
+app.add_middleware(ModelVersionMiddleware, registry=model_registry)
 
 # =========
 # Auth
 # =========
 
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+def busy_exception():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many login attempts in progress, try again shortly",
+        headers={"Retry-After": "1"},
+    )
+
+
+async def verify_password(plain_password, hashed_password):
+    try:
+        return await pwd_hasher.verify(plain_password, hashed_password)
+    except HasherBusy:
+        raise busy_exception()
+
 
+async def get_password_hash(password):
+    try:
+        return await pwd_hasher.hash(password)
+    except HasherBusy:
+        raise busy_exception()
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
 
 
-def get_user(email: str):
-    hash = db.get_auth(email)
+async def get_user(email: str):
+    hash = await db.get_auth(email)
     if hash:
         user_dict = {"email": email, "hashed_password": hash}
         return UserInDB(**user_dict)
 
 
-def authenticate_user(email: str, password: str):
-    user = get_user(email)
+token_verifier = TokenVerifier(SECRET_KEY, ALGORITHM, get_user, TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+
+async def authenticate_user(email: str, password: str):
+    user = await get_user(email)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password(password, user.hashed_password):
         return False
     return user
 
@@ -130,15 +319,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-        token_data = TokenData(email=email)
-    except JWTError:
-        raise credentials_exception
-    user = get_user(email=token_data.email)
+    user = await token_verifier.verify(token)
     if user is None:
         raise credentials_exception
     return user
@@ -148,151 +329,191 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
 # Algorithms
 # ===========
 
-review_mtx = load_npz("data/sparse_ratings.npz")
-critic_map = np.load("data/critics.npy", allow_pickle=True)
-movie_ids = np.load("data/tmdb_ids.npy", allow_pickle=True)
-print("running global scope")
 
+async def get_model():
+    # Requests keep the model they started with across a reload. Without a
+    # model they wait for a load in progress, and once one has failed get 503
+    # until the watcher's next retry succeeds
+    if model_registry.model is not None or model_registry.error is None:
+        try:
+            model = await model_registry.aget()
+        except Exception:
+            model = None
+        if model is not None:
+            return model
+    raise HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Model is unavailable",
+        headers={"Retry-After": str(MODEL_POLL_INTERVAL)},
+    )
+
+
+@timed("model")
+def get_preference_vector(model, user_ratings):
+    return model.movie_index.preference_vector(user_ratings)
+
+
+async def pull_preferences(model, email):
+    """
+    Get the cached UserPreferences for a user's non-negative ratings, None if
+    the ratings couldn't be pulled
+    """
+    entry = await ratings_cache.entry(email)
+    if entry is None:
+        return None
+    return entry_preferences(model, entry)
+
+
+def ratings_unavailable():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Ratings are unavailable",
+    )
 
-def get_preference_vector(user_ratings):
-    vec = np.zeros((review_mtx.shape[1]))
-    vec[:] = np.NaN
 
-    for review in user_ratings:
-        # TODO: handle case where id isn't present in movie_ids
-        el = np.where(movie_ids == review["id"])[0]
-        if el.any():
-            vec[el] = review["rating"]
-        else:
-            print("Movie", review["id"], "doesn't exist in movie_ids")
+def entry_preferences(model, entry):
+    # A UserRatings' preferences, rebuilt when they belong to other model arrays
+    if entry.prefs is None or entry.prefs_fingerprint != model.fingerprint:
+        with phase("model"):
+            entry.prefs = UserPreferences(model.matcher, model.movie_index, entry.ratings)
+            entry.prefs_fingerprint = model.fingerprint
+    return entry.prefs
 
-    return vec
 
+@timed("model")
+def match_movies(model, matches):
+    # Build dict of movie, critic rating, user rating for a matched critic
+    return [
+        {
+            "movie_id": int(model.movie_ids[movie_col]),
+            "critic_rating": float(critic_rating),
+            "user_rating": float(user_rating),
+        }
+        for movie_col, critic_rating, user_rating in zip(
+            matches.cols, matches.critic_ratings, matches.user_ratings
+        )
+    ]
 
-def closest_critic(user_prefs, num_common=MIN_COMMON):
-    # Get non-zero row/col pairs in review matrix
-    rows, cols = review_mtx.nonzero()
 
-    # Get rated movies
-    rated_cols = np.where(~np.isnan(user_prefs))[0]
+def critic_search(model):
+    # CriticMatcher or CriticIndex, both rank critics the same way
+    if MATCH_MODE == "approximate" and model.critic_index is not None:
+        return model.critic_index
+    return model.matcher
 
-    # Gets the index in cols, where cols has a value in rated cols
-    rated_idxs = np.array(
-        [
-            cols_idx
-            for rated_col in rated_cols
-            for cols_idx in np.where(cols == rated_col)[0]
-        ]
+
+def search_mode(model):
+    # Part of the match cache key, approximate results may differ from exact ones
+    return "exact" if critic_search(model) is model.matcher else "approximate"
+
+
+def cached_closest(model, user_prefs, num_common):
+    """
+    The closest critic for a preference vector, shared by every user who
+    rated the same movies the same way
+    """
+    return match_cache.get_or_compute(
+        model,
+        "closest",
+        (search_mode(model), num_common),
+        user_prefs,
+        lambda: critic_search(model).closest_critic(user_prefs, num_common),
     )
 
-    if len(rated_idxs) == 0:
-        return "", -1
 
-    # Calculate sum of square difference for each critic
-    critic_deltas = {}
-    for idx in rated_idxs:
-        critic, movie_col = rows[idx], cols[idx]
-        critic_rating = review_mtx[critic, movie_col]
-
-        if critic not in critic_deltas:
-            critic_deltas[critic] = []
-        critic_deltas[critic] += [((user_prefs[movie_col] - critic_rating) ** 2, movie_col)]
-
-    # Drop critics who have less than N reviews in common
-    critic_deltas = {
-        critic: deltas
-        for critic, deltas in critic_deltas.items()
-        if len(deltas) >= num_common
-    }
+def cached_top_critics(model, user_prefs, k, metric, num_common):
+    return match_cache.get_or_compute(
+        model,
+        "top",
+        (search_mode(model), k, metric, num_common),
+        user_prefs,
+        lambda: critic_search(model).top_critics(user_prefs, k, metric, num_common),
+    )
 
-    # Accumulate deltas
-    total_deltas = {
-        critic: sum([d[0] for d in deltas]) for critic, deltas in critic_deltas.items()
-    }
 
-    # find closest critic
-    min_critic = min(total_deltas, key=total_deltas.get)
+def closest_match(model, prefs):
+    if critic_search(model) is model.matcher:
+        # Kept current as the user rates, no search needed and nothing to
+        # gain from the match cache
+        return prefs.accumulator.closest_critic(MIN_COMMON)
+    return cached_closest(model, prefs.vec, MIN_COMMON)
+
+
+@timed("model")
+def closest_critic(model, user_prefs, num_common=MIN_COMMON):
+    critic, matches = cached_closest(model, user_prefs, num_common)
+    if critic is None:
+        return "", -1
+
+    return model.critic_names[critic], match_movies(model, matches)
+
 
-    # Build dict of movie, critic rating, user rating for best match
-    match_movies = [
+@timed("model")
+def top_critics(model, user_prefs, k, metric, num_common=MIN_COMMON):
+    return [
         {
-            "movie_id": int(movie_ids[movie_col]),
-            "critic_rating": float(review_mtx[min_critic, movie_col]),
-            "user_rating": float(user_prefs[movie_col]),
+            "critic_id": model.critic_names[match.critic],
+            "score": match.score,
+            "num_common": len(match.matches.cols),
+            "matches": match_movies(model, match.matches),
         }
-        for _, movie_col in critic_deltas[min_critic]
+        for match in cached_top_critics(model, user_prefs, k, metric, num_common)
     ]
 
-    return critic_map[min_critic], match_movies
-
-
-def get_next(seen_movies):
-    movie_picks = [
-        (13455, 42),
-        (1366, 69),
-        (197, 85),
-        (4951, 69),
-        (11324, 76),
-        (584, 50),
-        (1824, 65),
-        (65, 54),
-        (245, 55),
-        (2105, 61),
-        (818, 44),
-        (310, 57),
-        (118, 51),
-        (411, 61),
-        (11247, 53),
-        (435, 50),
-        (141, 80),
-        (601, 72),
-        (12, 86),
-        (98, 87),
-        (674, 74),
-        (675, 81),
-        (8488, 62),
-        (9806, 75),
-        (24, 81),
-        (254, 50),
-        (4964, 83),
-        (9291, 62),
-        (508, 72),
-        (603, 85),
-        (10625, 66),
-        (693, 58),
-        (787, 58),
-        (11036, 85),
-        (161, 80),
-        (285, 72),
-        (22, 86),
-        (114, 68),
-        (565, 48),
-        (9816, 59),
-        (215, 59),
-        (4247, 43),
-        (1584, 64),
-        (809, 69),
-        (810, 52),
-        (187, 78),
-        (557, 67),
-        (559, 51),
-        (1895, 66),
-        (122, 86),
-        (544, 61),
-        (597, 69),
-        (8373, 57),
-        (1858, 85),
-        (10229, 78),
-        (74, 42),
-        (9522, 70),
-        (12153, 55),
-    ]
-    unrated = [x for x in movie_picks if x[0] not in seen_movies]
-    return random.choice(unrated)
+
+@timed("model")
+def get_next(model, seen_movies=(), candidates=None):
+    return model.calibrator.next_movie(seen_movies, candidates)
 
 
-#def get_unseen_critic_movies(critic_id: str):
-    #
+@timed("model")
+def recommend_movies(model, prefs, seen_ids, n, num_critics=1):
+    if num_critics == 1:
+        critic, _ = closest_match(model, prefs)
+        critics = [] if critic is None else [critic]
+        weights = [1.0]
+    else:
+        matches = cached_top_critics(model, prefs.vec, num_critics, "pearson", MIN_COMMON)
+        critics = [match.critic for match in matches]
+        weights = [max(match.score, 0.0) for match in matches]
+    if not critics:
+        return [], []
+
+    seen_cols = model.movie_index.lookup(seen_ids).cols
+    cols, scores = model.recommender.top_movies(
+        np.array(critics), np.array(weights), seen_cols, n
+    )
+    movies = [
+        {"movie_id": int(model.movie_ids[col]), "score": float(score)}
+        for col, score in zip(cols, scores)
+    ]
+    return [model.critic_names[critic] for critic in critics], movies
+
+
+def calibration_state(model, entry):
+    """
+    Everything a calibrating client shows after a rating: the next movie to
+    rate, whether the user is calibrated and their closest critic
+    """
+    prefs = entry_preferences(model, entry)
+    with phase("model"):
+        candidates = prefs.accumulator.candidates(CALIBRATION_CANDIDATES, MIN_COMMON)
+    seen_ids = [item['id'] for item in entry.ratings]
+    pick = get_next(model, seen_ids, candidates)
+    critic, matches = closest_match(model, prefs)
+    return {
+        "next": {
+            "movie_id": pick[0] if pick else None,
+            "avg_rating": pick[1] if pick else None,
+        },
+        "calibrated": sum(item['rating'] >= 0 for item in entry.ratings) >= CALIBRATION_COUNT,
+        "critic": {
+            "critic_id": "" if critic is None else model.critic_names[critic],
+            "matches": [] if critic is None else match_movies(model, matches),
+        },
+        "unknown_movies": prefs.unknown,
+        "model_version": model.version,
+    }
 
 
 # =========
@@ -304,65 +525,319 @@ def index():
     return RedirectResponse(url="/docs")
 
 
+@app.get("/ready")
+def is_ready():
+    ready = model_registry.ready
+    return JSONResponse(
+        status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={
+            "ready": ready,
+            "model": model_registry.ready,
+            "model_version": model_registry.version,
+            "model_error": model_registry.error,
+            "db": db.pool is not None,
+            **startup.stats(),
+        },
+    )
+
+
+def require_admin(authorization: Optional[str] = Header(None)):
+    if ADMIN_TOKEN is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    expected = f"Bearer {ADMIN_TOKEN}".encode()
+    if authorization is None or not hmac.compare_digest(authorization.encode(), expected):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+@app.get("/stats", dependencies=[Depends(require_admin)])
+def get_stats():
+    return {
+        "ratings_cache": ratings_cache.stats(),
+        "password_hasher": pwd_hasher.stats(),
+        "tokens": token_verifier.stats(),
+        "model": model_registry.stats(),
+        "match_cache": match_cache.stats(),
+        "admission": admission.stats(),
+    }
+
+
+@app.get("/metrics", dependencies=[Depends(require_admin)])
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+def get_profile(profile_id: str):
+    # Collapsed stacks of a request sent with the X-Profile header
+    capture = profiler.get(profile_id)
+    if capture is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+    return PlainTextResponse(
+        capture.collapsed(),
+        headers={
+            "X-Profile-Path": capture.path,
+            "X-Profile-Samples": str(capture.samples),
+            "X-Profile-Duration": f"{capture.duration:.6f}",
+        },
+    )
+
+
 @app.get("/calibrated")
 async def is_calibrated(current_user: User = Depends(get_current_user)):
-    ratings = db.pull_ratings(current_user.email) 
+    ratings = await ratings_cache.pull_ratings(current_user.email)
     if ratings is None: return False
     ratings = [True for item in ratings if item['rating'] >= 0]
     return {"calibrated": len(ratings) >= CALIBRATION_COUNT}
 
 
 @app.get("/critic/{critic_id}")
-async def get_critic(critic_id: str):  # TODO: Return all critic reviews
+async def get_critic(
+    critic_id: str,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=MAX_REVIEWS),
+    sort: str = "score_desc",
+    model: Model = Depends(get_model),
+):
     # list of: critic name, tmdb id, score, contents
-    critic_id = unquote(critic_id)
-    return '' #gcp.get_critic("Roger Moore")
+    if sort not in SORTS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"sort must be one of {', '.join(SORTS)}",
+        )
+    with phase("model"):
+        profile = model.critic_store.profile(unquote(critic_id), offset, limit, sort)
+    if profile is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Critic not found")
+    return profile
 
 
 @app.post("/ratings", status_code=status.HTTP_200_OK)
 async def get_ratings(current_user: User = Depends(get_current_user)):
-    return db.pull_ratings(current_user.email)
+    return await ratings_cache.pull_ratings(current_user.email)
 
 
 @app.post("/rating/", status_code=status.HTTP_200_OK)
 async def rate_movie(
     movie_id: int, rating: float, current_user: User = Depends(get_current_user)
 ):
-    db.send_rating(current_user.email, movie_id, rating)
+    if not valid_rating(rating):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=RATING_RANGE)
+    succ = await ratings_cache.send_rating(current_user.email, movie_id, rating)
+    if not succ:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Rating could not be saved",
+        )
+    return {}
+
+
+@app.post("/ratings/batch", status_code=status.HTTP_200_OK)
+async def rate_movies(
+    ratings: List[Rating],
+    current_user: User = Depends(get_current_user),
+    model: Model = Depends(get_model),
+):
+    if len(ratings) > MAX_BATCH_RATINGS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {MAX_BATCH_RATINGS} ratings per batch",
+        )
+    unknown = model.movie_index.lookup([item.movie_id for item in ratings]).unknown
+    # Movie ids rather than the ratings, which may not be JSON numbers
+    invalid = [item.movie_id for item in ratings if not item.valid]
+    if unknown or invalid:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail={"unknown_movies": unknown, "invalid_ratings": invalid, "rating_range": RATING_RANGE},
+        )
+
+    succ = await ratings_cache.send_ratings(
+        current_user.email, [(item.movie_id, item.rating) for item in ratings]
+    )
+    if not succ:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Ratings could not be saved",
+        )
     return {}
 
 
 @app.post("/clear_ratings", status_code=status.HTTP_200_OK)
 async def clear_ratings(current_user: User = Depends(get_current_user)):
-    db.del_ratings(current_user.email)
+    if not await ratings_cache.del_ratings(current_user.email):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Ratings could not be cleared",
+        )
     return {}
-    # TODO raise http expection on error
 
 
 @app.get("/rec/next")
-async def get_next_rec(current_user: User = Depends(get_current_user)):
-    ratings = db.pull_ratings(current_user.email)
+async def get_next_rec(
+    current_user: User = Depends(get_current_user), model: Model = Depends(get_model)
+):
+    ratings = await ratings_cache.pull_ratings(current_user.email)
     if ratings is None:
-        next_id, avg_rating = get_next()
-        return {"movie_id": next_id, "avg_rating": avg_rating}
-    
-    seen_ids = [item['id'] for item in ratings]
-    next_id, avg_rating = get_next(seen_ids)
+        pick = get_next(model)
+    else:
+        prefs = await pull_preferences(model, current_user.email)
+        candidates = None
+        if prefs is not None:
+            with phase("model"):
+                candidates = prefs.accumulator.candidates(CALIBRATION_CANDIDATES, MIN_COMMON)
+        seen_ids = [item['id'] for item in ratings]
+        pick = get_next(model, seen_ids, candidates)
+
+    if pick is None:
+        return {"movie_id": None, "avg_rating": None}
+    next_id, avg_rating = pick
     return {"movie_id": next_id, "avg_rating": avg_rating}
 
 
+@app.websocket("/ws/calibrate")
+async def calibration_session(websocket: WebSocket, token: str = Query(...)):
+    """
+    Calibrate over one connection instead of rate, next, calibrated and
+    critic requests per movie
+
+    The client sends {"movie_id", "rating"} messages, the rating between 0
+    and MAX_RATING or UNSEEN_RATING. After connecting and after every rating
+    the server sends the calibration_state, or {"error"} for a bad message.
+    The token is checked once, then only for expiry.
+
+    Every message takes a token from the user's /rating/ bucket, so a session
+    rates no faster than the route, and a user gets at most
+    CALIBRATION_SESSIONS sessions at once.
+    """
+    user = await token_verifier.verify(token)
+    if user is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    if not admission.open_session(user.email, CALIBRATION_SESSIONS):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    try:
+        await calibrate(websocket, token, user)
+    finally:
+        admission.close_session(user.email)
+
+
+async def calibrate(websocket, token, user):
+    # calibration_session once the session is counted against the user's limit
+    entry = await ratings_cache.entry(user.email)
+    if entry is None:
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+        return
+
+    gate = admission.gates["/rating/"]
+    await websocket.accept()
+    try:
+        model = await get_model()
+        await websocket.send_json(calibration_state(model, entry))
+        while True:
+            message = await asyncio.wait_for(
+                websocket.receive_text(), timeout=CALIBRATION_IDLE_TIMEOUT
+            )
+            if token_verifier.decode(token) is None:
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+                return
+            try:
+                admission.rate_limit(gate, user.email)
+            except Rejected as e:
+                metrics.ADMISSION_SHED.inc("/ws/calibrate", e.reason)
+                await websocket.send_json(
+                    {"error": "Too many ratings", "retry_after": max(1, math.ceil(e.retry_after))}
+                )
+                continue
+            try:
+                message = json.loads(message)
+                movie_id, rating = int(message["movie_id"]), float(message["rating"])
+            except (KeyError, TypeError, ValueError, OverflowError):
+                await websocket.send_json({"error": "Expected {\"movie_id\": int, \"rating\": float}"})
+                continue
+            if not valid_rating(rating):
+                await websocket.send_json({"error": RATING_RANGE})
+                continue
+
+            model = await get_model()
+            unknown = model.movie_index.lookup([movie_id]).unknown
+            if unknown:
+                await websocket.send_json({"error": "Unknown movie", "unknown_movies": unknown})
+                continue
+            succ = await ratings_cache.send_ratings(user.email, [(movie_id, rating)], entry)
+            if not succ:
+                await websocket.send_json({"error": "Rating could not be saved"})
+                continue
+            await websocket.send_json(calibration_state(model, entry))
+    except HTTPException:
+        # No model to calibrate against yet
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+    except asyncio.TimeoutError:
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+
+
 @app.get("/rec/critic")
-async def get_critic_rec(current_user: User = Depends(get_current_user)):
-    user_prefs = db.pull_ratings(current_user.email)  # pull user ratings
-    user_prefs = [item for item in user_prefs if item['rating'] >= 0]
-    prev_vec = get_preference_vector(user_prefs)
-    critic, matches = closest_critic(prev_vec)
-    return {"critic_id": critic, "matches": list(matches)}
+async def get_critic_rec(
+    current_user: User = Depends(get_current_user), model: Model = Depends(get_model)
+):
+    prefs = await pull_preferences(model, current_user.email)
+    if prefs is None:
+        raise ratings_unavailable()
+    with phase("model"):
+        critic, matches = closest_match(model, prefs)
+    if critic is None:
+        return {"critic_id": "", "matches": [], "unknown_movies": prefs.unknown}
+    return {
+        "critic_id": model.critic_names[critic],
+        "matches": match_movies(model, matches),
+        "unknown_movies": prefs.unknown,
+    }
+
+
+@app.get("/rec/critics")
+async def get_critic_recs(
+    k: int = Query(5, ge=1, le=MAX_CRITICS),
+    metric: str = "mse",
+    current_user: User = Depends(get_current_user),
+    model: Model = Depends(get_model),
+):
+    if metric not in METRICS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"metric must be one of {', '.join(METRICS)}",
+        )
+    prefs = await pull_preferences(model, current_user.email)
+    if prefs is None:
+        raise ratings_unavailable()
+    critics = top_critics(model, prefs.vec, k, metric)
+    return {"metric": metric, "critics": critics, "unknown_movies": prefs.unknown}
+
+
+@app.get("/rec/movies")
+async def get_movie_recs(
+    n: int = Query(10, ge=1, le=MAX_MOVIES),
+    critics: int = Query(1, ge=1, le=MAX_CRITICS),
+    current_user: User = Depends(get_current_user),
+    model: Model = Depends(get_model),
+):
+    ratings = await ratings_cache.pull_ratings(current_user.email)
+    prefs = None if ratings is None else await pull_preferences(model, current_user.email)
+    if prefs is None:
+        raise ratings_unavailable()
+    seen_ids = [item['id'] for item in ratings]
+    critic_ids, movies = recommend_movies(model, prefs, seen_ids, n, critics)
+    return {"critics": critic_ids, "movies": movies}
 
 
 @app.post("/login", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(form_data.username, form_data.password)
+    user = await authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -378,7 +853,9 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 
 @app.post("/register", response_model=Token)
 async def register(form_data: OAuth2PasswordRequestForm = Depends()):
-    succ = db.add_account(form_data.username, get_password_hash(form_data.password))
+    password_hash = await get_password_hash(form_data.password)
+    succ = await db.add_account(form_data.username, password_hash)
+    token_verifier.invalidate(form_data.username)
     if not succ:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -390,3 +867,6 @@ async def register(form_data: OAuth2PasswordRequestForm = Depends()):
         data={"sub": form_data.username}, expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "bearer"}
+
+
+startup.mark("import")
@@ -0,0 +1,245 @@
+"""
+Critic match results shared between users who gave the same answers.
+
+Most users calibrate on the same short list of movies, so many of them send
+the same preference vector. A result is keyed by a hash of the sorted
+(column, rating) pairs the user rated, the model's fingerprint and the
+search parameters, so it is reused by every user with those answers and
+never outlives the model arrays it was computed on.
+
+Results live in an in-process LRU and optionally in a local SQLite file,
+which survives restarts and is shared by the workers on a host. The file
+holds plain JSON, a closest critic search as
+
+    {"critic": 12, "matches": {"critics": [...], "cols": [...], ...}}
+
+with "critic" and "matches" null when no critic qualified, and a top
+critics search as a list of {"critic", "score", "matches"}.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from cache import LRUCache
+from matching import Match, Overlap
+from metrics import MATCH_HIT_RATIO, MATCH_LOOKUPS, MATCH_SAVED_SECONDS, report_error
+
+
+def match_key(fingerprint, kind, params, user_prefs):
+    """
+    @param:
+    fingerprint - str fingerprint of the model the result is computed on
+    kind - str search name, e.g. "closest"
+    params - tuple of the search parameters
+    user_prefs - float array over movie columns, NaN where unrated
+
+    @return:
+    str - hex digest, the same for equal rated columns and ratings
+    """
+    cols = np.flatnonzero(~np.isnan(user_prefs))
+    digest = hashlib.sha256(repr((fingerprint, kind, params)).encode())
+    digest.update(cols.astype(np.int64).tobytes())
+    digest.update(np.asarray(user_prefs[cols], dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def encode_overlap(overlap):
+    if overlap is None:
+        return None
+    return {field: array.tolist() for field, array in zip(Overlap._fields, overlap)}
+
+
+def decode_overlap(data):
+    if data is None:
+        return None
+    return Overlap(
+        critics=np.asarray(data["critics"], dtype=np.int64),
+        cols=np.asarray(data["cols"], dtype=np.int64),
+        critic_ratings=np.asarray(data["critic_ratings"], dtype=np.float64),
+        user_ratings=np.asarray(data["user_ratings"], dtype=np.float64),
+    )
+
+
+def encode_result(value):
+    """
+    @param:
+    value - (critic, Overlap) from closest_critic or list of Match from top_critics
+
+    @return:
+    str - JSON text
+    """
+    if isinstance(value, list):
+        data = [
+            {"critic": match.critic, "score": match.score, "matches": encode_overlap(match.matches)}
+            for match in value
+        ]
+    else:
+        critic, matches = value
+        data = {"critic": critic, "matches": encode_overlap(matches)}
+    return json.dumps(data)
+
+
+def decode_result(text):
+    """
+    @return:
+    the result encode_result was given
+    """
+    data = json.loads(text)
+    if isinstance(data, list):
+        return [
+            Match(int(item["critic"]), float(item["score"]), decode_overlap(item["matches"]))
+            for item in data
+        ]
+    critic = data["critic"]
+    return (None if critic is None else int(critic)), decode_overlap(data["matches"])
+
+
+class DiskStore:
+    def __init__(self, path, maxsize):
+        """
+        SQLite table of JSON encoded results, the least recently written are
+        dropped past maxsize
+
+        @param:
+        path - str database file, created if missing
+        maxsize - int maximum number of stored results
+        """
+        self.path = path
+        self.maxsize = maxsize
+        self.writes = 0
+        self._lock = threading.Lock()
+        # Results can be recomputed, so durability is traded for write speed
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        # Pickled results from before, never loaded
+        self.conn.execute("DROP TABLE IF EXISTS matches")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, seconds REAL NOT NULL, written REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_written ON results (written)")
+
+    def get(self, key):
+        """
+        @return:
+        (value, seconds), None if the key isn't stored
+        """
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT value, seconds FROM results WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return decode_result(row[0]), row[1]
+
+    def put(self, key, value, seconds):
+        text = encode_result(value)
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (key, text, seconds, time.time()),
+            )
+            self.writes += 1
+            # Trim in batches rather than on every write
+            if self.writes % 100 == 0:
+                self.conn.execute(
+                    "DELETE FROM results WHERE key IN (SELECT key FROM results "
+                    "ORDER BY written DESC LIMIT -1 OFFSET ?)",
+                    (self.maxsize,),
+                )
+
+    def close(self):
+        self.conn.close()
+
+
+class MatchCache:
+    def __init__(self, maxsize, disk_path=None, disk_size=100000):
+        """
+        @param:
+        maxsize - int results kept in memory
+        disk_path - str SQLite file backing the memory cache, None for memory only
+        disk_size - int results kept on disk
+        """
+        self.memory = LRUCache(maxsize, ttl=None)  # key -> (result, seconds)
+        self.disk = None if disk_path is None else DiskStore(disk_path, disk_size)
+        self.lookups = {}  # kind -> {"hit", "disk_hit", "miss"} counts
+        self.saved_seconds = 0.0
+        self.compute_seconds = 0.0
+
+    def get_or_compute(self, model, kind, params, user_prefs, compute):
+        """
+        Get a search result for a preference vector, computing it on a miss
+
+        @param:
+        model - Model the search runs on
+        kind, params - search name and parameters, part of the key
+        user_prefs - float array over movie columns, NaN where unrated
+        compute - callable () -> result, run on a miss
+
+        @return:
+        the result, shared with other callers so it must not be mutated
+        """
+        key = match_key(model.fingerprint, kind, params, user_prefs)
+        item = self.memory.get(key)
+        result = "hit"
+        if item is None and self.disk is not None:
+            item = self.disk_get(key)
+            result = "disk_hit"
+            if item is not None:
+                self.memory.put(key, item)
+
+        if item is None:
+            result = "miss"
+            start = time.perf_counter()
+            value = compute()
+            seconds = time.perf_counter() - start
+            self.compute_seconds += seconds
+            self.memory.put(key, (value, seconds))
+            if self.disk is not None:
+                self.disk_put(key, value, seconds)
+        else:
+            value, seconds = item
+            self.saved_seconds += seconds
+            MATCH_SAVED_SECONDS.inc(kind, amount=seconds)
+
+        self.count(kind, result)
+        return value
+
+    def disk_get(self, key):
+        try:
+            return self.disk.get(key)
+        except (sqlite3.Error, ValueError, KeyError, TypeError) as e:
+            report_error("match_cache", "disk_get", e)
+            return None
+
+    def disk_put(self, key, value, seconds):
+        try:
+            self.disk.put(key, value, seconds)
+        except (sqlite3.Error, ValueError, TypeError) as e:
+            report_error("match_cache", "disk_put", e)
+
+    def count(self, kind, result):
+        counts = self.lookups.setdefault(kind, dict.fromkeys(("hit", "disk_hit", "miss"), 0))
+        counts[result] += 1
+        MATCH_LOOKUPS.inc(kind, result)
+        MATCH_HIT_RATIO.set(1 - counts["miss"] / sum(counts.values()), kind)
+
+    def clear(self):
+        self.memory.clear()
+
+    def stats(self):
+        hits = sum(c["hit"] + c["disk_hit"] for c in self.lookups.values())
+        lookups = sum(sum(c.values()) for c in self.lookups.values())
+        return {
+            **self.memory.stats(),
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "by_kind": {kind: dict(counts) for kind, counts in self.lookups.items()},
+            "disk": self.disk is not None,
+            "saved_seconds": self.saved_seconds,
+            "compute_seconds": self.compute_seconds,
+        }
@@ -0,0 +1,407 @@
+"""
+Critic matching over the sparse critic x movie review matrix.
+
+The kernels here work on the compressed column (CSC) arrays directly, so a
+request only touches the stored entries of the movies a user has rated.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+
+METRICS = ("sse", "mse", "pearson", "cosine")
+COSINE_SHRINK = 10
+
+
+# Parallel arrays, one element per (critic, rated movie) pair that both rated
+Overlap = namedtuple("Overlap", ["critics", "cols", "critic_ratings", "user_ratings"])
+
+# A ranked critic, with the movies they share with the user
+Match = namedtuple("Match", ["critic", "score", "matches"])
+
+# Raw arrays of a compressed sparse matrix, CSC or CSR
+Compressed = namedtuple("Compressed", ["indptr", "indices", "data"])
+
+# Matrix columns for a batch of movie ids, positions index back into the batch
+Lookup = namedtuple("Lookup", ["cols", "positions", "unknown"])
+
+
+def expand_ranges(starts, counts):
+    """
+    Concatenate the integer ranges [start, start + count) without a Python loop
+    """
+    ends = np.cumsum(counts)
+    offsets = np.arange(counts.sum()) - np.repeat(ends - counts, counts)
+    return np.repeat(starts, counts) + offsets
+
+
+def column_entries(indptr, cols):
+    """
+    Get the positions of every stored entry in the given columns
+
+    @param:
+    indptr - CSC column pointer array
+    cols - int array of column indices
+
+    @return:
+    positions - int array indexing the CSC indices/data arrays, column by column
+    counts - int array, number of entries gathered for each column
+    """
+    starts = indptr[cols]
+    counts = indptr[cols + 1] - starts
+    return expand_ranges(starts, counts), counts
+
+
+class MovieIndex:
+    def __init__(self, movie_ids):
+        """
+        @param:
+        movie_ids - int array of TMDB ids, one per review matrix column
+        """
+        movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        self.order = np.argsort(movie_ids, kind="stable")
+        self.sorted_ids = movie_ids[self.order]
+
+    def lookup(self, ids):
+        """
+        Map a batch of TMDB ids to review matrix columns
+
+        @param:
+        ids - int array of TMDB ids
+
+        @return:
+        Lookup - cols and positions are parallel arrays, an id present in several
+            columns appears once per column; unknown is a list of missing ids
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        left = np.searchsorted(self.sorted_ids, ids, side="left")
+        right = np.searchsorted(self.sorted_ids, ids, side="right")
+        counts = right - left
+        return Lookup(
+            cols=self.order[expand_ranges(left, counts)],
+            positions=np.repeat(np.arange(len(ids)), counts),
+            unknown=[int(i) for i in ids[counts == 0]],
+        )
+
+    def preference_vector(self, user_ratings):
+        """
+        Build a preference vector from a list of ratings
+
+        @param:
+        user_ratings - list of dicts [{id, rating}], later ratings of a movie win
+
+        @return:
+        vec - float array over movie columns, NaN where unrated
+        unknown - list of rated ids missing from the review matrix
+        """
+        vec = np.full(len(self.order), np.nan)
+
+        ids = np.array([review["id"] for review in user_ratings], dtype=np.int64)
+        ratings = np.array([review["rating"] for review in user_ratings], dtype=float)
+        found = self.lookup(ids)
+        vec[found.cols] = ratings[found.positions]
+
+        return vec, found.unknown
+
+
+class CriticMatcher:
+    def __init__(self, csc, csr):
+        """
+        @param:
+        csc - Compressed columns of the review matrix, explicit zeros removed
+        csr - Compressed rows of the same matrix
+        """
+        self.csc = csc
+        self.csr = csr
+        self.num_critics = len(csr.indptr) - 1
+        self.num_movies = len(csc.indptr) - 1
+
+    @classmethod
+    def from_matrix(cls, review_mtx):
+        csr = review_mtx.tocsr()
+        csr.eliminate_zeros()
+        csr.sort_indices()
+        csc = csr.tocsc()
+        csc.sort_indices()
+        return cls(
+            Compressed(csc.indptr, csc.indices, csc.data),
+            Compressed(csr.indptr, csr.indices, csr.data),
+        )
+
+    def overlap(self, user_prefs):
+        """
+        Gather every critic rating for the movies in a preference vector
+
+        @param:
+        user_prefs - float array over movie columns, NaN where unrated
+
+        @return:
+        Overlap - ordered by movie column, then critic row
+        """
+        rated_cols = np.flatnonzero(~np.isnan(user_prefs))
+        positions, counts = column_entries(self.csc.indptr, rated_cols)
+        return Overlap(
+            critics=self.csc.indices[positions],
+            cols=np.repeat(rated_cols, counts),
+            critic_ratings=self.csc.data[positions],
+            user_ratings=np.repeat(user_prefs[rated_cols], counts),
+        )
+
+    def rows_overlap(self, user_prefs, critics):
+        """
+        Gather the given critics' ratings for the movies in a preference vector,
+        O(nnz of those rows) however many movies the user rated
+
+        @param:
+        user_prefs - float array over movie columns, NaN where unrated
+        critics - int array of distinct critic rows
+
+        @return:
+        Overlap - ordered by critic, then movie column
+        """
+        critics = np.asarray(critics, dtype=self.csr.indices.dtype)
+        starts = self.csr.indptr[critics]
+        counts = self.csr.indptr[critics + 1] - starts
+        positions = expand_ranges(starts, counts)
+        cols = self.csr.indices[positions]
+        user_ratings = user_prefs[cols]
+        rated = ~np.isnan(user_ratings)
+        return Overlap(
+            critics=np.repeat(critics, counts)[rated],
+            cols=cols[rated],
+            critic_ratings=self.csr.data[positions][rated],
+            user_ratings=user_ratings[rated],
+        )
+
+    def scores(self, overlap, metric):
+        """
+        Score every critic against the user over the movies they have in common
+
+        @param:
+        overlap - Overlap for the user
+        metric - str one of METRICS
+
+        @return:
+        cost - float array per critic row, lower is a closer match
+        score - float array per critic row, the metric value reported to clients
+        common - int array, number of movies in common per critic row
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric}")
+
+        rows, user, critic = overlap.critics, overlap.user_ratings, overlap.critic_ratings
+
+        def total(weights):
+            return np.bincount(rows, weights=weights, minlength=self.num_critics)
+
+        common = np.bincount(rows, minlength=self.num_critics)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if metric == "sse":
+                score = total((user - critic) ** 2)
+                return score, score, common
+            if metric == "mse":
+                score = total((user - critic) ** 2) / common
+                return score, score, common
+
+            user_sq, critic_sq, cross = total(user ** 2), total(critic ** 2), total(user * critic)
+            if metric == "pearson":
+                user_sum, critic_sum = total(user), total(critic)
+                score = (common * cross - user_sum * critic_sum) / np.sqrt(
+                    (common * user_sq - user_sum ** 2) * (common * critic_sq - critic_sum ** 2)
+                )
+            else:
+                # Shrink cosine similarity toward 0 for critics with few movies in common
+                score = cross / np.sqrt(user_sq * critic_sq) * common / (common + COSINE_SHRINK)
+
+        # Constant ratings on either side have no correlation
+        score = np.nan_to_num(score, nan=0.0, posinf=0.0, neginf=0.0)
+        return -score, score, common
+
+    def top_critics(self, user_prefs, k, metric="sse", num_common=1, critics=None):
+        """
+        Rank the k closest critics to the user
+
+        @param:
+        user_prefs - float array over movie columns, NaN where unrated
+        k - int number of critics to return
+        metric - str one of METRICS
+        num_common - int minimum number of movies in common with the user
+        critics - int array of distinct critic rows to rank, None for every critic
+
+        @return:
+        list of Match, closest first, ties go to the lowest critic row
+        """
+        if critics is None:
+            overlap = self.overlap(user_prefs)
+        else:
+            overlap = self.rows_overlap(user_prefs, critics)
+        cost, score, common = self.scores(overlap, metric)
+
+        candidates = np.flatnonzero(common >= max(num_common, 1))
+        if len(candidates) == 0 or k < 1:
+            return []
+
+        # One partition pass, then widen to every critic tied with the kth
+        cand_cost = cost[candidates]
+        k = min(k, len(candidates))
+        kth = cand_cost[np.argpartition(cand_cost, k - 1)[k - 1]]
+        selected = candidates[cand_cost <= kth]
+        selected = selected[np.lexsort((selected, cost[selected]))][:k]
+
+        results = []
+        for critic in selected:
+            mask = overlap.critics == critic
+            results.append(
+                Match(int(critic), float(score[critic]), Overlap(*(arr[mask] for arr in overlap)))
+            )
+        return results
+
+    def closest_critic(self, user_prefs, num_common):
+        """
+        Find the critic with the lowest summed squared difference to the user
+
+        @param:
+        user_prefs - float array over movie columns, NaN where unrated
+        num_common - int minimum number of movies in common with the user
+
+        @return:
+        critic - int critic row, None if no critic has enough movies in common
+        matches - Overlap restricted to that critic, None if there is no critic
+        """
+        best = self.top_critics(user_prefs, 1, "sse", num_common)
+        if not best:
+            return None, None
+        return best[0].critic, best[0].matches
+
+    def critic_overlap(self, critic, user_prefs):
+        """
+        Gather one critic's ratings for the movies in a preference vector
+
+        @return:
+        Overlap - ordered by movie column
+        """
+        start, end = self.csr.indptr[critic], self.csr.indptr[critic + 1]
+        cols = self.csr.indices[start:end]
+        user_ratings = user_prefs[cols]
+        rated = ~np.isnan(user_ratings)
+        return Overlap(
+            critics=np.full(rated.sum(), critic, dtype=self.csc.indices.dtype),
+            cols=cols[rated],
+            critic_ratings=self.csr.data[start:end][rated],
+            user_ratings=user_ratings[rated],
+        )
+
+
+class CriticAccumulator:
+    def __init__(self, matcher, user_prefs):
+        """
+        Running per critic summed squared difference and common counts for one
+        user, kept current one rated movie at a time
+
+        @param:
+        matcher - CriticMatcher
+        user_prefs - float array over movie columns, NaN where unrated
+        """
+        self.matcher = matcher
+        self.vec = np.array(user_prefs, dtype=float)
+
+        overlap = matcher.overlap(self.vec)
+        self.sq_sum = np.bincount(
+            overlap.critics,
+            weights=(overlap.user_ratings - overlap.critic_ratings) ** 2,
+            minlength=matcher.num_critics,
+        ).astype(float)
+        self.common = np.bincount(overlap.critics, minlength=matcher.num_critics)
+
+    def set(self, cols, rating):
+        """
+        Set the user's rating for some movie columns, O(nnz of those columns)
+
+        @param:
+        cols - int array of movie columns
+        rating - float new rating, NaN to remove the rating
+        """
+        csc = self.matcher.csc
+        for col in cols:
+            start, end = csc.indptr[col], csc.indptr[col + 1]
+            critics, critic_ratings = csc.indices[start:end], csc.data[start:end]
+
+            old = self.vec[col]
+            if not np.isnan(old):
+                self.sq_sum[critics] -= (old - critic_ratings) ** 2
+                self.common[critics] -= 1
+            if not np.isnan(rating):
+                self.sq_sum[critics] += (rating - critic_ratings) ** 2
+                self.common[critics] += 1
+            self.vec[col] = rating
+
+            # Don't let subtraction error linger once a critic has no overlap
+            self.sq_sum[critics[self.common[critics] == 0]] = 0.0
+
+    def closest_critic(self, num_common):
+        """
+        Find the critic with the lowest summed squared difference, O(#critics)
+
+        @return:
+        critic - int critic row, None if no critic has enough movies in common
+        matches - Overlap restricted to that critic, None if there is no critic
+        """
+        sq_sum = np.where(self.common >= max(num_common, 1), self.sq_sum, np.inf)
+        critic = int(np.argmin(sq_sum))
+        if not np.isfinite(sq_sum[critic]):
+            return None, None
+        return critic, self.matcher.critic_overlap(critic, self.vec)
+
+    def candidates(self, count, num_common):
+        """
+        Get the critics still in contention to be the user's closest match
+
+        @param:
+        count - int maximum number of critics returned
+        num_common - int movies in common wanted, relaxed while no critic has that many
+
+        @return:
+        int array of critic rows closest first by mean squared difference, None if
+            the user has no movies in common with any critic yet
+        """
+        most_common = self.common.max() if len(self.common) else 0
+        if most_common == 0:
+            return None
+        eligible = np.flatnonzero(self.common >= min(num_common, most_common))
+        mse = self.sq_sum[eligible] / self.common[eligible]
+        if len(eligible) > count:
+            keep = np.argpartition(mse, count - 1)[:count]
+            eligible, mse = eligible[keep], mse[keep]
+        return eligible[np.argsort(mse, kind="stable")]
+
+
+class UserPreferences:
+    def __init__(self, matcher, movie_index, user_ratings):
+        """
+        A user's preference vector and critic distances, updated as they rate
+
+        @param:
+        matcher - CriticMatcher
+        movie_index - MovieIndex over the same columns
+        user_ratings - list of dicts [{id, rating}], negative ratings are ignored
+        """
+        self.movie_index = movie_index
+        vec, self.unknown = movie_index.preference_vector(
+            [item for item in user_ratings if item["rating"] >= 0]
+        )
+        self.accumulator = CriticAccumulator(matcher, vec)
+
+    @property
+    def vec(self):
+        return self.accumulator.vec
+
+    def rate(self, movie_id, rating):
+        """
+        Apply one new rating, a negative rating removes the movie
+        """
+        found = self.movie_index.lookup([movie_id])
+        if found.unknown:
+            if movie_id not in self.unknown:
+                self.unknown.append(movie_id)
+            return
+        self.accumulator.set(found.cols, rating if rating >= 0 else np.nan)
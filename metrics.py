@@ -0,0 +1,348 @@
+"""
+Request metrics in the Prometheus text format.
+
+Every request gets a RequestMetrics in a context variable. Code on the hot
+path marks what it is doing with phase(), so a request's wall time splits
+into queue (waiting for admission), db, model, serialize and other
+(routing, auth, validation and glue), each counted once even when phases
+nest.
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import time
+from contextlib import contextmanager
+
+from fastapi.routing import APIRoute
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+BATCH_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+PHASES = ("queue", "db", "model", "serialize", "other")
+
+logger = logging.getLogger("cinetrics")
+
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        """
+        @param:
+        name, help - str metric name and description
+        labels - tuple of str label names
+        buckets - sorted tuple of float bucket upper bounds, +Inf is implied
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # label values -> [bucket counts..., sum, count]
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, series in sorted(self.series.items()):
+            labels = format_labels(self.labels, label_values)
+            sep = "," if labels else ""
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{labels}{sep}le="{bound:g}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels}{sep}le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{{{labels}}} {series[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}  # label values -> count
+
+    def inc(self, *label_values, amount=1):
+        self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, count in sorted(self.series.items()):
+            lines.append(f"{self.name}{{{format_labels(self.labels, label_values)}}} {count}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}  # label values -> value
+
+    def set(self, value, *label_values):
+        self.series[label_values] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for label_values, value in sorted(self.series.items()):
+            lines.append(f"{self.name}{{{format_labels(self.labels, label_values)}}} {value:g}")
+        return lines
+
+
+def format_labels(names, values):
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+
+REQUESTS = Counter("cinetrics_requests_total", "Requests served", ("route", "method", "status"))
+REQUEST_SECONDS = Histogram(
+    "cinetrics_request_duration_seconds", "Request latency", ("route", "method")
+)
+PHASE_SECONDS = Histogram(
+    "cinetrics_request_phase_seconds", "Request time spent per phase", ("route", "phase")
+)
+REQUEST_DB_CALLS = Histogram(
+    "cinetrics_request_db_calls", "Database round trips per request", ("route",), COUNT_BUCKETS
+)
+DB_SECONDS = Histogram("cinetrics_db_call_duration_seconds", "Database call latency", ("method",))
+MATCH_LOOKUPS = Counter(
+    "cinetrics_match_cache_lookups_total", "Match cache lookups", ("kind", "result")
+)
+MATCH_HIT_RATIO = Gauge(
+    "cinetrics_match_cache_hit_ratio", "Fraction of match cache lookups served from cache", ("kind",)
+)
+MATCH_SAVED_SECONDS = Counter(
+    "cinetrics_match_cache_saved_seconds_total",
+    "Compute time the cached matches originally took, summed over hits",
+    ("kind",),
+)
+RATINGS_PENDING = Gauge("cinetrics_ratings_pending", "Acknowledged ratings not yet in the database", ())
+RATING_FLUSHES = Counter("cinetrics_rating_flushes_total", "Write-behind rating flushes", ("result",))
+RATING_FLUSH_ROWS = Histogram(
+    "cinetrics_rating_flush_rows", "Ratings per successful flush", (), BATCH_BUCKETS
+)
+ADMISSION_WAIT = Histogram(
+    "cinetrics_admission_wait_seconds", "Time requests waited for admission", ("route", "class")
+)
+ADMISSION_SHED = Counter(
+    "cinetrics_admission_shed_total", "Requests turned away by admission control", ("route", "reason")
+)
+ADMISSION_ACTIVE = Gauge("cinetrics_admission_active", "Admitted requests running", ("route",))
+ADMISSION_QUEUED = Gauge("cinetrics_admission_queued", "Requests waiting for admission", ("route",))
+ERRORS = Counter(
+    "cinetrics_errors_total", "Errors handled with a fallback instead of failing", ("component", "operation")
+)
+
+REGISTRY = (
+    REQUESTS,
+    REQUEST_SECONDS,
+    PHASE_SECONDS,
+    REQUEST_DB_CALLS,
+    DB_SECONDS,
+    MATCH_LOOKUPS,
+    MATCH_HIT_RATIO,
+    MATCH_SAVED_SECONDS,
+    RATINGS_PENDING,
+    RATING_FLUSHES,
+    RATING_FLUSH_ROWS,
+    ADMISSION_WAIT,
+    ADMISSION_SHED,
+    ADMISSION_ACTIVE,
+    ADMISSION_QUEUED,
+    ERRORS,
+)
+
+
+def render(registry=REGISTRY):
+    """
+    @return:
+    str - every metric in the Prometheus text exposition format
+    """
+    return "\n".join(line for metric in registry for line in metric.render()) + "\n"
+
+
+def report_error(component, operation, error):
+    """
+    Count and log an error the caller recovers from, e.g. a failed database
+    call answered with a fallback
+
+    @param:
+    component - str part of the app, e.g. "db"
+    operation - str what failed, e.g. "pull_ratings"
+    error - exception or str describing the problem
+    """
+    ERRORS.inc(component, operation)
+    logger.error("%s error [%s]: %s", component, operation, error)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.route = None
+        self.db_calls = 0
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.current = "other"
+        self.since = time.perf_counter()
+
+    def switch(self, phase):
+        """
+        Charge the time since the last switch to the current phase and start
+        another one
+
+        @return:
+        str - the phase that was running, to switch back to
+        """
+        now = time.perf_counter()
+        self.phases[self.current] += now - self.since
+        previous, self.current, self.since = self.current, phase, now
+        return previous
+
+
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+@contextmanager
+def phase(name):
+    request = current_request.get()
+    if request is None:
+        yield
+        return
+    previous = request.switch(name)
+    try:
+        yield
+    finally:
+        request.switch(previous)
+
+
+def timed(name):
+    """
+    Decorator running a function inside phase(name)
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def db_call(fn):
+    """
+    Decorator for a coroutine method making one database round trip
+    """
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            with phase("db"):
+                return await fn(*args, **kwargs)
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - start, fn.__name__)
+            request = current_request.get()
+            if request is not None:
+                request.db_calls += 1
+
+    return wrapper
+
+
+class TimedRoute(APIRoute):
+    """
+    Route that labels the request with its path template and charges the time
+    between the endpoint returning and the response going out to serialize
+    """
+
+    def matches(self, scope):
+        match, child_scope = super().matches(scope)
+        request = current_request.get()
+        if request is not None and request.route is None and match.value:
+            request.route = self.path
+        return match, child_scope
+
+    def get_route_handler(self):
+        call = self.dependant.call
+        if getattr(call, "timed_route", False):
+            return super().get_route_handler()
+        if asyncio.iscoroutinefunction(call):
+
+            @functools.wraps(call)
+            async def endpoint(*args, **kwargs):
+                result = await call(*args, **kwargs)
+                switch_to_serialize()
+                return result
+
+        else:
+
+            @functools.wraps(call)
+            def endpoint(*args, **kwargs):
+                result = call(*args, **kwargs)
+                switch_to_serialize()
+                return result
+
+        endpoint.timed_route = True
+        self.dependant.call = endpoint
+        return super().get_route_handler()
+
+
+def switch_to_serialize():
+    request = current_request.get()
+    if request is not None:
+        request.switch("serialize")
+
+
+class MetricsMiddleware:
+    def __init__(self, app, profiler=None):
+        """
+        @param:
+        app - ASGI app
+        profiler - profiler.SamplingProfiler run for requests asking for it, None to disable
+        """
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request = RequestMetrics()
+        token = current_request.set(request)
+        status = 500
+        capture = self.profiler.start(scope) if self.profiler is not None else None
+
+        async def send_timed(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                request.switch("other")
+                if capture is not None:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"x-profile-id", capture.id.encode())
+                    ]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            request.switch("other")
+            if capture is not None:
+                self.profiler.stop(capture)
+            current_request.reset(token)
+
+            route = request.route or "unmatched"
+            REQUESTS.inc(route, scope["method"], status)
+            REQUEST_SECONDS.observe(time.perf_counter() - start, route, scope["method"])
+            for name, seconds in request.phases.items():
+                PHASE_SECONDS.observe(seconds, route, name)
+            REQUEST_DB_CALLS.observe(request.db_calls, route)
@@ -0,0 +1,8 @@
+-- Key user_preferences by (username, movieid) so ratings can be upserted.
+-- Re-rating a movie used to insert another row, keep only the newest one.
+DELETE FROM user_preferences
+WHERE rowid NOT IN (
+    SELECT max(rowid) FROM user_preferences GROUP BY username, movieid
+);
+
+ALTER TABLE user_preferences ALTER PRIMARY KEY USING COLUMNS (username, movieid);
@@ -0,0 +1,336 @@
+"""
+Model artifacts for critic matching.
+
+A model directory holds plain .npy arrays that are opened with
+mmap_mode="r", so every worker process maps the same page cache pages
+instead of unpickling a private copy:
+
+    csr_indptr, csr_indices, csr_data   critic x movie ratings, by critic row
+    csc_indptr, csc_indices, csc_data   the same ratings, by movie column
+    movie_ids                           int64 TMDB id of each movie column
+    critic_offsets, critic_names        utf-8 string table, critic i's name is
+                                        critic_names[critic_offsets[i]:critic_offsets[i + 1]]
+
+and optionally:
+
+    VERSION                             text file naming the model version, the
+                                        directory name and fingerprint are used
+                                        without one
+
+and optionally, written by save_model / quantize_model.py:
+
+    score_codec                         [offset, scale] when csr_data and csc_data
+                                        hold uint8 codes, see quantize.py
+    critic_mean                         mean score per critic, computed at load
+                                        time when missing
+
+and optionally, written by build_review_store.py:
+
+    review_offsets, review_text         utf-8 string table of review text, one
+                                        per csr entry
+
+and optionally, written by build_ann_index.py:
+
+    ann_factors, ann_centroids,         approximate critic search index, see ann.py
+    ann_list_indptr, ann_list_critics
+"""
+import hashlib
+import os
+
+import numpy as np
+
+from ann import ANN_ARRAYS, CriticIndex
+from calibration import Calibrator
+from critics import CriticStore
+from matching import Compressed, CriticMatcher, MovieIndex
+from quantize import CODEC_ARRAY, MEANS_ARRAY, critic_means, decode, encode
+from recommend import Recommender
+
+
+MODEL_PATH = "data/model"
+
+ARRAYS = (
+    "csr_indptr",
+    "csr_indices",
+    "csr_data",
+    "csc_indptr",
+    "csc_indices",
+    "csc_data",
+    "movie_ids",
+    "critic_offsets",
+    "critic_names",
+)
+
+
+class StringTable:
+    def __init__(self, offsets, blob):
+        """
+        @param:
+        offsets - int array of len(table) + 1 byte offsets into blob
+        blob - uint8 array of concatenated utf-8 strings
+        """
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(s) for s in encoded])
+        blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(offsets, blob)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        i = int(i) % len(self)
+        return bytes(self.blob[self.offsets[i] : self.offsets[i + 1]]).decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class Model:
+    def __init__(
+        self,
+        csc,
+        csr,
+        movie_ids,
+        critic_names,
+        reviews=None,
+        ann=None,
+        version=None,
+        means=None,
+        fingerprint=None,
+    ):
+        """
+        @param:
+        csc, csr - Compressed arrays of the critic x movie review matrix
+        movie_ids - int64 array of TMDB ids, one per movie column
+        critic_names - StringTable, one name per critic row
+        reviews - StringTable of review text per csr entry, None if not built
+        ann - dict of ANN_ARRAYS name -> array, None if not built
+        version - str name of the artifact version
+        means - float array of each critic's mean score, computed from csr if None
+        fingerprint - str hash of the arrays the model was loaded from, see fingerprint
+        """
+        self.shape = (len(csr.indptr) - 1, len(csc.indptr) - 1)
+        if len(movie_ids) != self.shape[1] or len(critic_names) != self.shape[0]:
+            raise ValueError(
+                f"Model shape {self.shape} doesn't match {len(critic_names)} critics "
+                f"and {len(movie_ids)} movie ids"
+            )
+        if reviews is not None and len(reviews) != len(csr.data):
+            raise ValueError(f"{len(reviews)} reviews for {len(csr.data)} ratings")
+
+        self.version = version
+        self.fingerprint = fingerprint
+        self.movie_ids = movie_ids
+        self.critic_names = critic_names
+        self.matcher = CriticMatcher(csc, csr)
+        self.critic_means = means if means is not None else critic_means(csr, self.shape[0])
+        self.movie_index = MovieIndex(movie_ids)
+        self.calibrator = Calibrator(self.matcher, movie_ids)
+        self.recommender = Recommender(self.matcher, self.calibrator.means)
+        self.critic_store = CriticStore(
+            self.matcher,
+            movie_ids,
+            critic_names,
+            self.recommender.order,
+            self.critic_means,
+            reviews,
+        )
+        self.critic_index = None
+        if ann is not None:
+            self.critic_index = CriticIndex(
+                self.matcher,
+                ann["ann_factors"],
+                ann["ann_centroids"],
+                ann["ann_list_indptr"],
+                ann["ann_list_critics"],
+            )
+
+    def validate(self):
+        """
+        Check the compressed arrays are consistent, O(nnz)
+
+        @raise:
+        ValueError - describing the first problem found
+        """
+        num_critics, num_movies = self.shape
+        for name, arrays, bound, axis in (
+            ("csr", self.matcher.csr, num_movies, "movies"),
+            ("csc", self.matcher.csc, num_critics, "critics"),
+        ):
+            indptr = np.asarray(arrays.indptr)
+            if indptr[0] != 0 or np.any(np.diff(indptr) < 0):
+                raise ValueError(f"{name}_indptr isn't non-decreasing from 0")
+            if not indptr[-1] == len(arrays.indices) == len(arrays.data):
+                raise ValueError(
+                    f"{name}_indptr ends at {indptr[-1]} for {len(arrays.indices)} indices "
+                    f"and {len(arrays.data)} ratings"
+                )
+            if len(arrays.indices) and not 0 <= np.min(arrays.indices) <= np.max(arrays.indices) < bound:
+                raise ValueError(f"{name}_indices out of range for {bound} {axis}")
+            if not np.all(np.isfinite(arrays.data)):
+                raise ValueError(f"{name}_data has non-finite ratings")
+        if len(self.matcher.csr.data) != len(self.matcher.csc.data):
+            raise ValueError(
+                f"{len(self.matcher.csr.data)} csr ratings but {len(self.matcher.csc.data)} csc ratings"
+            )
+
+
+def fingerprint(arrays):
+    """
+    Hash model arrays as stored, so two models share a fingerprint only when
+    they hold the same scores in the same encoding
+
+    @param:
+    arrays - dict of name -> array
+
+    @return:
+    str - hex digest of the arrays' names, dtypes, shapes and contents
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        digest.update(f"{name} {array.dtype.str} {array.shape}\n".encode())
+        digest.update(array.data)
+    return digest.hexdigest()
+
+
+def model_version(path, digest):
+    """
+    @param:
+    digest - str the model's fingerprint
+
+    @return:
+    str - the VERSION file's contents, else the name of the directory path
+        resolves to and the start of the fingerprint, which changes when the
+        arrays are rewritten in place
+    """
+    version_file = os.path.join(path, "VERSION")
+    if os.path.exists(version_file):
+        with open(version_file) as f:
+            return f.read().strip()
+    return f"{os.path.basename(os.path.realpath(path))}-{digest[:12]}"
+
+
+def load_model(path=MODEL_PATH):
+    """
+    Memory map a model directory written by save_model
+
+    @return:
+    Model
+    """
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ARRAYS}
+
+    codec = None
+    if os.path.exists(os.path.join(path, f"{CODEC_ARRAY}.npy")):
+        codec = np.load(os.path.join(path, f"{CODEC_ARRAY}.npy"))
+        arrays[CODEC_ARRAY] = codec
+
+    means = None
+    if os.path.exists(os.path.join(path, f"{MEANS_ARRAY}.npy")):
+        means = np.load(os.path.join(path, f"{MEANS_ARRAY}.npy"), mmap_mode="r")
+
+    reviews = None
+    if os.path.exists(os.path.join(path, "review_offsets.npy")):
+        reviews = StringTable(
+            np.load(os.path.join(path, "review_offsets.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "review_text.npy"), mmap_mode="r"),
+        )
+
+    ann = None
+    if os.path.exists(os.path.join(path, "ann_factors.npy")):
+        ann = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ANN_ARRAYS}
+
+    # Everything a match result depends on, review text doesn't change any
+    digest = fingerprint({**arrays, **(ann or {})})
+    for name in ("csr_data", "csc_data"):
+        arrays[name] = decode(arrays[name], codec)
+
+    return Model(
+        Compressed(arrays["csc_indptr"], arrays["csc_indices"], arrays["csc_data"]),
+        Compressed(arrays["csr_indptr"], arrays["csr_indices"], arrays["csr_data"]),
+        arrays["movie_ids"],
+        StringTable(arrays["critic_offsets"], arrays["critic_names"]),
+        reviews,
+        ann,
+        model_version(path, digest),
+        means,
+        digest,
+    )
+
+
+def save_model(path, review_mtx, critic_names, movie_ids, codec="float64"):
+    """
+    Write a model directory
+
+    @param:
+    path - str output directory, created if missing
+    review_mtx - scipy sparse critic x movie matrix
+    critic_names - sequence of str, one per row
+    movie_ids - sequence of int TMDB ids, one per column
+    codec - str score storage, one of quantize.CODECS
+    """
+    matcher = CriticMatcher.from_matrix(review_mtx)
+    write_model(path, matcher, [str(name) for name in critic_names], movie_ids, codec)
+
+
+def write_model(path, matcher, critic_names, movie_ids, codec="float64"):
+    """
+    Write a model directory from a CriticMatcher's arrays, see save_model
+    """
+    names = StringTable.from_strings(critic_names)
+    # Both layouts hold the same scores, so they get the same code map
+    csr_data, params = encode(matcher.csr.data, codec)
+    csc_data, _ = encode(matcher.csc.data, codec)
+    arrays = {
+        "csr_indptr": matcher.csr.indptr,
+        "csr_indices": matcher.csr.indices,
+        "csr_data": csr_data,
+        "csc_indptr": matcher.csc.indptr,
+        "csc_indices": matcher.csc.indices,
+        "csc_data": csc_data,
+        "movie_ids": np.asarray(movie_ids, dtype=np.int64),
+        "critic_offsets": names.offsets,
+        "critic_names": names.blob,
+        MEANS_ARRAY: critic_means(matcher.csr, matcher.num_critics),
+    }
+    if params is not None:
+        arrays[CODEC_ARRAY] = params
+    elif os.path.exists(os.path.join(path, f"{CODEC_ARRAY}.npy")):
+        os.remove(os.path.join(path, f"{CODEC_ARRAY}.npy"))
+
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(array))
+
+
+def save_reviews(path, reviews):
+    """
+    Add review text to a model directory
+
+    @param:
+    path - str model directory
+    reviews - sequence of str, one per csr entry, "" where there is no text
+    """
+    table = StringTable.from_strings(reviews)
+    np.save(os.path.join(path, "review_offsets.npy"), table.offsets)
+    np.save(os.path.join(path, "review_text.npy"), table.blob)
+
+
+def save_ann(path, arrays):
+    """
+    Add an approximate critic search index to a model directory
+
+    @param:
+    path - str model directory
+    arrays - dict of ANN_ARRAYS name -> array, from ann.build_index
+    """
+    for name in ANN_ARRAYS:
+        np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(arrays[name]))
@@ -0,0 +1,114 @@
+"""
+Opt-in sampling profiler for single requests.
+
+A request sent with the profile header set to the admin token gets a
+background thread that samples the event loop thread's stack every few
+milliseconds until the response is done. Without a token nothing is
+profiled. Samples are kept in the collapsed stack format flame graph
+tools read ("outer;inner;leaf count" per line).
+
+The event loop interleaves requests, so a capture also holds samples of
+whatever else ran on the loop meanwhile. Work pushed to executor threads,
+e.g. bcrypt, shows up as the loop waiting.
+"""
+import hmac
+import sys
+import threading
+import time
+import uuid
+
+from cache import LRUCache
+
+
+PROFILE_HEADER = b"x-profile"
+SAMPLE_INTERVAL = 0.005  # seconds
+MAX_ACTIVE = 1  # concurrent captures, further requests go unprofiled
+MAX_DEPTH = 64  # frames kept per sample, innermost first
+
+
+class Capture:
+    def __init__(self, path, thread_id):
+        self.id = uuid.uuid4().hex
+        self.path = path
+        self.thread_id = thread_id
+        self.stacks = {}  # collapsed stack -> samples
+        self.samples = 0
+        self.started = time.monotonic()
+        self.duration = None
+        self.done = threading.Event()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        names = []
+        while frame is not None and len(names) < MAX_DEPTH:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+            frame = frame.f_back
+        if names:
+            stack = ";".join(reversed(names))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def run(self, interval):
+        while not self.done.wait(interval):
+            self.sample()
+
+    def collapsed(self):
+        """
+        @return:
+        str - one "stack count" line per distinct stack, most sampled first
+        """
+        lines = sorted(self.stacks.items(), key=lambda item: -item[1])
+        return "".join(f"{stack} {count}\n" for stack, count in lines)
+
+
+class SamplingProfiler:
+    def __init__(self, token=None, interval=SAMPLE_INTERVAL, max_active=MAX_ACTIVE, keep=50):
+        """
+        @param:
+        token - str profile header value that turns profiling on, None to never profile
+        interval - float seconds between samples
+        max_active - int captures allowed to run at once
+        keep - int finished captures kept for retrieval
+        """
+        self.token = None if token is None else token.encode()
+        self.interval = interval
+        self.max_active = max_active
+        self.active = 0
+        self.captures = LRUCache(keep, ttl=None)  # id -> finished Capture
+
+    def start(self, scope):
+        """
+        Start a capture if the request asks for one
+
+        @param:
+        scope - ASGI http scope, run on the event loop thread
+
+        @return:
+        Capture, None if the request isn't profiled
+        """
+        if self.token is None or self.active >= self.max_active:
+            return None
+        headers = dict(scope.get("headers", []))
+        if not hmac.compare_digest(headers.get(PROFILE_HEADER, b""), self.token):
+            return None
+
+        self.active += 1
+        capture = Capture(scope["path"], threading.get_ident())
+        threading.Thread(
+            target=capture.run, args=(self.interval,), name="profiler", daemon=True
+        ).start()
+        return capture
+
+    def stop(self, capture):
+        capture.done.set()
+        capture.duration = time.monotonic() - capture.started
+        self.active -= 1
+        self.captures.put(capture.id, capture)
+
+    def get(self, capture_id):
+        """
+        @return:
+        Capture, None if it expired or never existed
+        """
+        return self.captures.get(capture_id, count=False)
@@ -0,0 +1,112 @@
+"""
+Compact score storage for model directories.
+
+Scores can be stored as float64 (exact), float16 (within 0.03 of the
+original on a 0-100 scale) or uint8 codes of an affine map over the score
+range (within half a step, about 0.2). The matching kernels gather a few
+entries at a time, so compact scores are wrapped in a QuantizedArray that
+decodes to float64 on indexing and every kernel runs unchanged. Squares and
+products of float16 scores would lose whole points, so they are never
+computed in float16.
+
+Scores are stored as is rather than centered per critic: every metric is
+computed over the movies a critic shares with the user, which a critic's
+global mean says nothing about, and centered values would need a wider
+code range for the same precision. Each critic's mean score is
+precomputed instead.
+"""
+import numpy as np
+
+
+CODECS = ("float64", "float16", "uint8")
+
+# Arrays written next to the model arrays
+CODEC_ARRAY = "score_codec"  # [offset, scale] of uint8 codes
+MEANS_ARRAY = "critic_mean"  # float64 mean score per critic row, 0 without reviews
+
+
+class QuantizedArray:
+    def __init__(self, codes, offset=0.0, scale=1.0):
+        """
+        Read-only float64 view of compact scores, value = offset + code * scale
+
+        @param:
+        codes - uint8 or float16 array
+        offset, scale - float
+        """
+        self.codes = codes
+        self.offset = float(offset)
+        self.scale = float(scale)
+        self.dtype = np.dtype(float)
+        self.shape = codes.shape
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, key):
+        values = np.asarray(self.codes[key], dtype=float)
+        if self.scale != 1.0 or self.offset != 0.0:
+            values = self.offset + values * self.scale
+        return values
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[:]
+        return values if dtype is None else values.astype(dtype, copy=False)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+
+def encode(data, codec):
+    """
+    @param:
+    data - float array of scores
+    codec - str one of CODECS
+
+    @return:
+    stored - array to save as the data array
+    params - float64 array [offset, scale] for uint8, None otherwise
+    """
+    data = np.asarray(data, dtype=float)
+    if codec == "float64":
+        return data, None
+    if codec == "float16":
+        return data.astype(np.float16), None
+    if codec != "uint8":
+        raise ValueError(f"Unknown codec {codec}")
+
+    low = float(data.min()) if len(data) else 0.0
+    high = float(data.max()) if len(data) else 0.0
+    scale = (high - low) / 255 or 1.0
+    codes = np.round((data - low) / scale).astype(np.uint8)
+    return codes, np.array([low, scale])
+
+
+def decode(stored, params):
+    """
+    Wrap a stored data array for the matching kernels
+
+    @param:
+    params - [offset, scale] from encode, None if stored holds the scores themselves
+    """
+    if params is not None:
+        return QuantizedArray(stored, params[0], params[1])
+    if stored.dtype != np.float64:
+        return QuantizedArray(stored)
+    return stored
+
+
+def critic_means(csr, num_critics):
+    """
+    @param:
+    csr - Compressed rows of the review matrix
+
+    @return:
+    float64 array of each critic's mean score, 0 for critics without reviews
+    """
+    count = np.diff(csr.indptr)
+    rows = np.repeat(np.arange(num_critics), count)
+    total = np.bincount(rows, weights=np.asarray(csr.data, dtype=float), minlength=num_critics)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.nan_to_num(total / count)
@@ -0,0 +1,44 @@
+"""
+Rewrite a model directory with compact score storage.
+
+    python quantize_model.py --model data/model --out data/model_uint8 --codec uint8
+
+Review text, the ANN index and VERSION are copied over unchanged. Memory,
+latency and accuracy against float64 are measured by bench/bench_quantized.py.
+"""
+import argparse
+import os
+import shutil
+
+from ann import ANN_ARRAYS
+from model import MODEL_PATH, load_model, write_model
+from quantize import CODECS
+
+
+EXTRAS = ["review_offsets.npy", "review_text.npy", "VERSION"] + [f"{name}.npy" for name in ANN_ARRAYS]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--codec", choices=CODECS, default="uint8")
+    args = parser.parse_args()
+
+    if os.path.realpath(args.model) == os.path.realpath(args.out):
+        parser.error("--out must be a different directory")
+
+    model = load_model(args.model)
+    write_model(args.out, model.matcher, list(model.critic_names), model.movie_ids, args.codec)
+    for name in EXTRAS:
+        if os.path.exists(os.path.join(args.model, name)):
+            shutil.copy(os.path.join(args.model, name), os.path.join(args.out, name))
+
+    before = model.matcher.csr.data.nbytes + model.matcher.csc.data.nbytes
+    after = load_model(args.out)
+    now = after.matcher.csr.data.nbytes + after.matcher.csc.data.nbytes
+    print(f"Wrote {args.out} with {args.codec} scores, {before} -> {now} bytes of score data")
+
+
+if __name__ == "__main__":
+    main()
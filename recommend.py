@@ -0,0 +1,84 @@
+"""
+Movie recommendations from a user's matched critics.
+
+Each critic's ratings are sorted by score once per model, so a request only
+reads the head of a few sorted rows instead of scanning every movie.
+"""
+import numpy as np
+
+from matching import column_entries
+
+
+# Weight of a movie's mean critic score when blending several critics
+PRIOR_WEIGHT = 0.5
+
+
+class Recommender:
+    def __init__(self, matcher, means):
+        """
+        @param:
+        matcher - CriticMatcher
+        means - float array, mean critic rating of each movie column
+        """
+        self.matcher = matcher
+        self.means = means
+
+        # Entry positions of the CSR arrays, each critic's row best score first
+        csr = matcher.csr
+        rows = np.repeat(np.arange(matcher.num_critics), np.diff(csr.indptr))
+        self.order = np.lexsort((-np.asarray(csr.data, dtype=float), rows)).astype(np.int32)
+
+    def critic_head(self, critic, count):
+        """
+        @return:
+        cols - int array, a critic's top rated movie columns, best first
+        ratings - float array, the critic's rating of each
+        """
+        csr = self.matcher.csr
+        start = csr.indptr[critic]
+        end = min(csr.indptr[critic + 1], start + count)
+        positions = self.order[start:end]
+        return csr.indices[positions], csr.data[positions]
+
+    def top_movies(self, critics, weights, seen_cols, n):
+        """
+        Rank unseen movies by one critic, or a weighted blend of several
+
+        @param:
+        critics - int array of critic rows
+        weights - float array, one non-negative weight per critic
+        seen_cols - int array of movie columns the user already rated
+        n - int number of movies returned
+
+        @return:
+        cols - int array of movie columns, best first
+        scores - float array, the critic rating or blended score of each
+        """
+        # Seen movies can push at most len(seen_cols) entries out of each head
+        head = n + len(seen_cols)
+        heads = [self.critic_head(critic, head) for critic in critics]
+        if len(critics) == 1:
+            cols, scores = heads[0]
+            unseen = ~np.isin(cols, seen_cols)
+            return cols[unseen][:n], scores[unseen][:n]
+
+        cols = np.unique(np.concatenate([cols for cols, _ in heads]))
+        cols = cols[~np.isin(cols, seen_cols)]
+
+        # Every selected critic's rating of every candidate, not just the heads
+        positions, counts = column_entries(self.matcher.csc.indptr, cols)
+        raters = self.matcher.csc.indices[positions]
+        slots = np.repeat(np.arange(len(cols)), counts)
+
+        critic_weight = np.zeros(self.matcher.num_critics)
+        critic_weight[critics] = weights
+        rater_weight = critic_weight[raters]
+        weighted = np.bincount(
+            slots, weights=rater_weight * self.matcher.csc.data[positions], minlength=len(cols)
+        )
+        total_weight = np.bincount(slots, weights=rater_weight, minlength=len(cols))
+
+        # Shrink toward the movie's mean so one lone rater doesn't dominate
+        scores = (weighted + PRIOR_WEIGHT * self.means[cols]) / (total_weight + PRIOR_WEIGHT)
+        best = np.argsort(-scores, kind="stable")[:n]
+        return cols[best], scores[best]
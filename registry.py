@@ -0,0 +1,197 @@
+"""
+The active model version, reloaded in the background when the artifacts
+on disk change.
+
+A new version is deployed by writing a complete model directory and then
+pointing the model path at it, e.g. by swapping a symlink. The registry
+notices the change, loads and validates the new version off the event
+loop and swaps it in with a single assignment. Requests that already hold
+the old Model finish on it; its memory maps are released once the last
+one drops its reference.
+"""
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+from ann import ANN_ARRAYS
+from metrics import report_error
+from model import ARRAYS, load_model
+from quantize import CODEC_ARRAY
+
+
+# One element list per request holding the version of the model it used,
+# mutated rather than set so dependencies running in a copied context update it
+request_version = contextvars.ContextVar("request_version", default=None)
+
+
+def record_version(model):
+    used = request_version.get()
+    if used is not None and model is not None:
+        used[0] = model.version
+
+
+class ModelRegistry:
+    def __init__(self, path, startup, load=load_model):
+        """
+        @param:
+        path - str model directory, or a symlink to one
+        startup - Startup the first load time is recorded in
+        load - callable path -> Model
+        """
+        self.path = path
+        self.startup = startup
+        self._load = load
+        self.model = None
+        self.error = None
+        self.signature = None
+        self.active_path = None  # resolved directory of the active model
+        self.loaded_at = None
+        self.reloads = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.model is not None
+
+    @property
+    def version(self):
+        return None if self.model is None else self.model.version
+
+    def current_signature(self):
+        """
+        @return:
+        tuple - changes whenever the path points somewhere else or an array is rewritten
+        """
+        real = os.path.realpath(self.path)
+        names = [f"{name}.npy" for name in ARRAYS + (CODEC_ARRAY,) + ANN_ARRAYS] + ["VERSION"]
+        stamps = []
+        for name in names:
+            try:
+                stamps.append(os.stat(os.path.join(real, name)).st_mtime_ns)
+            except FileNotFoundError:
+                stamps.append(None)
+        return (real, tuple(stamps))
+
+    def reload(self, force=False):
+        """
+        Load, validate and swap in the model on disk if it changed, in the
+        calling thread
+
+        @return:
+        bool - True if a new version was swapped in
+        """
+        with self._lock:
+            signature = self.current_signature()
+            if not force and signature == self.signature:
+                return False
+
+            first = self.model is None
+            try:
+                with self.startup.phase("model") if first else nullcontext():
+                    model = self._load(self.path)
+                    model.validate()
+            except Exception as e:
+                self.failures += 1
+                self.error = repr(e)
+                # Remember the signature so a broken version isn't retried every
+                # poll, unless there is no model to serve meanwhile and the
+                # failure may have been transient
+                if not first:
+                    self.signature = signature
+                report_error("model", "reload", e)
+                if first:
+                    raise
+                return False
+
+            self.model = model
+            self.signature = signature
+            self.active_path = signature[0]
+            self.error = None
+            self.loaded_at = time.time()
+            self.reloads += not first
+            return True
+
+    def get(self):
+        """
+        Get the active model, loading it in the calling thread if there is none
+
+        @return:
+        Model, None if another caller's load failed meanwhile
+
+        @raise:
+        Exception - from the load, if there was no model and it failed
+        """
+        model = self.model
+        if model is None:
+            self.reload()
+            model = self.model
+        record_version(model)
+        return model
+
+    async def aget(self):
+        """
+        Get the active model without blocking the event loop while it loads
+        """
+        model = self.model
+        if model is None:
+            model = await asyncio.get_event_loop().run_in_executor(None, self.get)
+        record_version(model)
+        return model
+
+    async def watch(self, interval):
+        """
+        Check for a new version every interval seconds, forever
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await loop.run_in_executor(None, self.reload)
+            except Exception as e:
+                report_error("model", "watch", e)
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "path": self.active_path,
+            "loaded_at": self.loaded_at,
+            "reloads": self.reloads,
+            "failures": self.failures,
+            "error": self.error,
+        }
+
+
+class ModelVersionMiddleware:
+    def __init__(self, app, registry):
+        """
+        Add an X-Model-Version header to every response, the version the
+        request ran on or else the active one
+        """
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        used = [None]
+        token = request_version.set(used)
+
+        async def send_version(message):
+            if message["type"] == "http.response.start":
+                version = used[0] or self.registry.version
+                if version is not None:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"x-model-version", str(version).encode())
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_version)
+        finally:
+            request_version.reset(token)
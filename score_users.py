@@ -0,0 +1,163 @@
+"""
+Batch job matching every user to their closest critic.
+
+    python score_users.py --out scores --workers 4
+
+User ratings are streamed from the database in chunks of whole users. Each
+chunk becomes a sparse user x movie matrix, and a worker process computes
+the summed squared difference to every critic with sparse matrix products
+against the review matrix, keeping memory bounded by the chunk size. Each
+chunk is written to <out>/part-NNNNN.npz with arrays:
+
+    emails      str, one per user
+    critic      int32 row of the closest critic, -1 if none has num_common movies in common
+    distance    float32 summed squared difference to that critic
+    common      int32 movies in common with that critic
+"""
+import argparse
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from cockroach import Cockroach
+from model import MODEL_PATH, load_model
+
+
+# Critic side of the products, built once per worker process
+_critics = None
+
+
+def init_worker(model_path):
+    global _critics
+    model = load_model(model_path)
+    csr = model.matcher.csr
+    data = np.asarray(csr.data, dtype=float)
+    ratings = csr_matrix((data, csr.indices, csr.indptr), shape=model.shape)
+    indicator = csr_matrix((np.ones(len(data)), csr.indices, csr.indptr), shape=model.shape)
+    squares = csr_matrix((data ** 2, csr.indices, csr.indptr), shape=model.shape)
+    _critics = {
+        "ratings": ratings.T.tocsr(),
+        "indicator": indicator.T.tocsr(),
+        "squares": squares.T.tocsr(),
+        "shape": model.shape,
+    }
+
+
+def score_chunk(path, emails, users, cols, ratings, num_common):
+    """
+    Match one chunk of users and write it to path
+
+    @param:
+    users, cols, ratings - parallel arrays, one entry per (user, movie column) rating
+    """
+    num_movies = _critics["shape"][1]
+    user_ratings = csr_matrix((ratings, (users, cols)), shape=(len(emails), num_movies))
+    user_indicator = csr_matrix(
+        (np.ones(len(ratings)), (users, cols)), shape=(len(emails), num_movies)
+    )
+
+    # sum (u - c)^2 over common movies = u^2 . [c] + [u] . c^2 - 2 u . c
+    common = (user_indicator @ _critics["indicator"]).toarray()
+    distance = (
+        user_ratings.multiply(user_ratings) @ _critics["indicator"]
+        + user_indicator @ _critics["squares"]
+        - 2 * (user_ratings @ _critics["ratings"])
+    ).toarray()
+    distance = np.where(common >= max(num_common, 1), np.maximum(distance, 0.0), np.inf)
+
+    rows = np.arange(len(emails))
+    critic = np.argmin(distance, axis=1)
+    best = distance[rows, critic]
+    matched = np.isfinite(best)
+    np.savez(
+        path,
+        emails=np.array(emails),
+        critic=np.where(matched, critic, -1).astype(np.int32),
+        distance=np.where(matched, best, np.nan).astype(np.float32),
+        common=np.where(matched, common[rows, critic], 0).astype(np.int32),
+    )
+    return len(emails)
+
+
+async def user_chunks(db, movie_index, chunk_users, prefetch):
+    """
+    Group the rating stream into chunks of whole users
+
+    @return:
+    async generator of (emails, users, cols, ratings)
+    """
+    emails, users, cols, ratings = [], [], [], []
+    async for username, movie, rating in db.stream_ratings(prefetch):
+        if not emails or emails[-1] != username:
+            if len(emails) == chunk_users:
+                yield emails, users, cols, ratings
+                emails, users, cols, ratings = [], [], [], []
+            emails.append(username)
+        if rating < 0:
+            continue
+        for col in movie_index.lookup([int(movie)]).cols:
+            users.append(len(emails) - 1)
+            cols.append(col)
+            ratings.append(float(rating))
+    if emails:
+        yield emails, users, cols, ratings
+
+
+async def run(args):
+    model = load_model(args.model)
+    os.makedirs(args.out, exist_ok=True)
+    db = Cockroach(min_size=1, max_size=1)
+    loop = asyncio.get_event_loop()
+
+    scored = 0
+    with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(args.model,)) as pool:
+        pending = set()
+        part = 0
+        async for emails, users, cols, ratings in user_chunks(
+            db, model.movie_index, args.chunk_users, args.prefetch
+        ):
+            # Bound the chunks held in memory while workers catch up
+            if len(pending) >= 2 * args.workers:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                scored += sum(task.result() for task in done)
+
+            path = os.path.join(args.out, f"part-{part:05d}.npz")
+            pending.add(
+                loop.run_in_executor(
+                    pool,
+                    score_chunk,
+                    path,
+                    emails,
+                    np.array(users, dtype=np.int64),
+                    np.array(cols, dtype=np.int64),
+                    np.array(ratings),
+                    args.num_common,
+                )
+            )
+            part += 1
+
+        if pending:
+            done, _ = await asyncio.wait(pending)
+            scored += sum(task.result() for task in done)
+
+    await db.close()
+    print(f"Scored {scored} users into {part} parts in {args.out}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--out", required=True, help="output directory")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-users", type=int, default=2000)
+    parser.add_argument("--prefetch", type=int, default=10000)
+    parser.add_argument("--num-common", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == "__main__":
+    main()
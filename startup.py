@@ -0,0 +1,30 @@
+"""
+Deferred initialization, so the API can serve requests before the heavy
+resources behind it are loaded.
+"""
+import time
+from contextlib import contextmanager
+
+
+class Startup:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.timings = {}  # phase name -> seconds
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings[name] = time.monotonic() - start
+
+    def mark(self, name):
+        """
+        Record the time from process start until now as a phase
+        """
+        self.timings[name] = time.monotonic() - self.started
+
+    def stats(self):
+        return {"uptime": time.monotonic() - self.started, "timings": dict(self.timings)}
+
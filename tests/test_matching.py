@@ -0,0 +1,182 @@
+"""
+The vectorized critic matching against the loop implementation it replaced,
+on the bundled review matrix.
+
+    python -m pytest tests
+"""
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix, load_npz
+
+from matching import CriticAccumulator, CriticMatcher, MovieIndex, UserPreferences
+from model import load_model
+
+
+MIN_COMMON = 3
+
+
+def loop_deltas(review_mtx, user_prefs, num_common):
+    """
+    The original closest_critic up to choosing a critic
+
+    @return:
+    dict critic row -> list of (squared difference, movie column), in the
+        order critics were first seen
+    """
+    rows, cols = review_mtx.nonzero()
+    rated_cols = np.where(~np.isnan(user_prefs))[0]
+    rated_idxs = [
+        cols_idx for rated_col in rated_cols for cols_idx in np.where(cols == rated_col)[0]
+    ]
+
+    critic_deltas = {}
+    for idx in rated_idxs:
+        critic, movie_col = rows[idx], cols[idx]
+        critic_rating = review_mtx[critic, movie_col]
+        if critic not in critic_deltas:
+            critic_deltas[critic] = []
+        critic_deltas[critic] += [((user_prefs[movie_col] - critic_rating) ** 2, movie_col)]
+
+    return {
+        critic: deltas for critic, deltas in critic_deltas.items() if len(deltas) >= num_common
+    }
+
+
+def loop_closest_critic(review_mtx, user_prefs, num_common):
+    """
+    @return:
+    (critic row, movie columns in common), None if no critic has enough in common
+    """
+    critic_deltas = loop_deltas(review_mtx, user_prefs, num_common)
+    if not critic_deltas:
+        return None
+    total_deltas = {critic: sum([d[0] for d in deltas]) for critic, deltas in critic_deltas.items()}
+    min_critic = min(total_deltas, key=total_deltas.get)
+    return min_critic, [movie_col for _, movie_col in critic_deltas[min_critic]]
+
+
+@pytest.fixture(scope="module")
+def bundled():
+    review_mtx = load_npz("data/sparse_ratings.npz").tocsr()
+    model = load_model("data/model")
+    assert review_mtx.shape == model.shape
+    assert np.array_equal(np.load("data/tmdb_ids.npy", allow_pickle=True), model.movie_ids)
+    return review_mtx, model
+
+
+def random_user(model, size, rng):
+    # Whole number ratings like the app's, so equal sums are exact ties on both sides
+    cols = rng.choice(model.shape[1], size, replace=False)
+    vec = np.full(model.shape[1], np.nan)
+    vec[cols] = rng.integers(0, 101, size)
+    return vec
+
+
+@pytest.mark.parametrize("size", [5, 10, 30])
+def test_closest_critic_matches_loop(bundled, size):
+    review_mtx, model = bundled
+    rng = np.random.default_rng(size)
+    for _ in range(10):
+        vec = random_user(model, size, rng)
+        want = loop_closest_critic(review_mtx, vec, MIN_COMMON)
+        critic, matches = model.matcher.closest_critic(vec, MIN_COMMON)
+        acc_critic, acc_matches = CriticAccumulator(model.matcher, vec).closest_critic(MIN_COMMON)
+
+        if want is None:
+            assert critic is None and acc_critic is None
+            continue
+        # The loop took the first critic it saw among equals, now the lowest row wins
+        deltas = loop_deltas(review_mtx, vec, MIN_COMMON)
+        totals = {c: sum(d[0] for d in ds) for c, ds in deltas.items()}
+        best = min(c for c, total in totals.items() if total == totals[want[0]])
+        assert critic == acc_critic == best
+
+        cols = [col for _, col in deltas[best]]
+        for found in (matches, acc_matches):
+            assert list(found.cols) == cols
+            assert np.array_equal(found.critic_ratings, [review_mtx[best, col] for col in cols])
+            assert np.array_equal(found.user_ratings, vec[cols])
+
+
+def assert_same_accumulator(acc, matcher):
+    fresh = CriticAccumulator(matcher, acc.vec)
+    assert np.array_equal(acc.common, fresh.common)
+    assert np.allclose(acc.sq_sum, fresh.sq_sum, rtol=0, atol=1e-6)
+    assert acc.closest_critic(MIN_COMMON)[0] == fresh.closest_critic(MIN_COMMON)[0]
+
+
+def test_accumulator_set_matches_rebuild(bundled):
+    _, model = bundled
+    rng = np.random.default_rng(7)
+    vec = random_user(model, 10, rng)
+    acc = CriticAccumulator(model.matcher, vec)
+    rated = np.flatnonzero(~np.isnan(vec))
+    unrated = np.flatnonzero(np.isnan(vec))
+    # Busy columns, so the updates touch many critics
+    busy = unrated[np.argsort(-np.diff(model.matcher.csc.indptr)[unrated])[:3]]
+
+    for col in busy:
+        acc.set([col], float(rng.integers(0, 101)))
+        assert_same_accumulator(acc, model.matcher)
+    for col in list(busy[:2]) + list(rated[:2]):
+        acc.set([col], 50.0)
+        assert_same_accumulator(acc, model.matcher)
+    for col in (busy[0], rated[0]):
+        acc.set([col], np.nan)
+        assert_same_accumulator(acc, model.matcher)
+    assert np.isnan(acc.vec[busy[0]]) and np.isnan(acc.vec[rated[0]])
+
+
+def test_preferences_rate_matches_rebuild(bundled):
+    _, model = bundled
+    ids = [int(movie_id) for movie_id in model.movie_ids[:5]]
+    prefs = UserPreferences(
+        model.matcher, model.movie_index, [{"id": i, "rating": 60.0} for i in ids[:3]]
+    )
+    prefs.rate(ids[3], 80.0)
+    prefs.rate(ids[0], 20.0)
+    prefs.rate(ids[1], -1)  # unseen removes the rating
+    prefs.rate(-5, 30.0)
+    assert prefs.unknown == [-5]
+    assert_same_accumulator(prefs.accumulator, model.matcher)
+    want, _ = model.movie_index.preference_vector(
+        [{"id": ids[0], "rating": 20.0}, {"id": ids[2], "rating": 60.0}, {"id": ids[3], "rating": 80.0}]
+    )
+    assert np.array_equal(prefs.vec, want, equal_nan=True)
+
+
+def test_preference_vector(bundled):
+    _, model = bundled
+    ids = [int(model.movie_ids[7]), int(model.movie_ids[4000]), -1]
+    vec, unknown = MovieIndex(model.movie_ids).preference_vector(
+        [{"id": movie_id, "rating": 50.0 + i} for i, movie_id in enumerate(ids)]
+    )
+    assert unknown == [-1]
+    assert np.flatnonzero(~np.isnan(vec)).tolist() == [7, 4000]
+    assert vec[7] == 50.0 and vec[4000] == 51.0
+
+
+def test_ties_go_to_lowest_row():
+    # Rows 0 and 2 are both 200 from the user, the loop meets row 2 first at column 0
+    review_mtx = csr_matrix(
+        np.array(
+            [
+                [0.0, 60.0, 40.0],
+                [0.0, 0.0, 90.0],
+                [40.0, 60.0, 0.0],
+            ]
+        )
+    )
+    vec = np.array([50.0, 50.0, 50.0])
+
+    assert loop_closest_critic(review_mtx, vec, 2) == (2, [0, 1])
+    critic, matches = CriticMatcher.from_matrix(review_mtx).closest_critic(vec, 2)
+    assert critic == 0
+    assert list(matches.cols) == [1, 2]
+
+
+def test_no_critic_in_common():
+    review_mtx = csr_matrix(np.array([[10.0, 0.0], [20.0, 0.0]]))
+    vec = np.array([np.nan, 50.0])
+    assert loop_closest_critic(review_mtx, vec, 1) is None
+    assert CriticMatcher.from_matrix(review_mtx).closest_critic(vec, 1) == (None, None)
@@ -0,0 +1,72 @@
+"""
+Compact score storage against the float64 model it was written from.
+
+    python -m pytest tests
+"""
+import numpy as np
+import pytest
+
+from bench.bench_quantized import compare
+from bench.common import synthetic_ratings
+from model import load_model, write_model
+from quantize import critic_means, decode, encode
+
+
+SIZES = (10, 100, 1000)  # movies rated per synthetic user
+USERS = 10  # synthetic users per size
+K = 10
+
+# decode - largest score error after a round trip
+# score - 99th percentile pearson difference for critics both top k lists
+#     share; with only a few movies in common a near constant critic can
+#     swing far on any rounding, so the largest difference isn't held to a limit
+# closest_sse - largest relative SSE excess of the quantized closest critic,
+#     scored exactly, over the exact closest critic
+# topk_overlap - smallest mean share of the exact top k found by the quantized search
+TOLERANCES = {
+    "float16": {"decode": 0.05, "score": 0.01, "closest_sse": 0.02, "topk_overlap": 0.95},
+    "uint8": {"decode": 0.2, "score": 0.05, "closest_sse": 0.1, "topk_overlap": 0.9},
+}
+
+
+@pytest.fixture(scope="module")
+def exact():
+    return load_model("data/model")
+
+
+@pytest.mark.parametrize("codec", sorted(TOLERANCES))
+def test_within_tolerance(exact, codec, tmp_path):
+    write_model(str(tmp_path), exact.matcher, list(exact.critic_names), exact.movie_ids, codec)
+    model = load_model(str(tmp_path))
+    assert model.fingerprint != exact.fingerprint
+
+    rng = np.random.default_rng(0)
+    vecs = [
+        exact.movie_index.preference_vector(synthetic_ratings(exact, size, rng))[0]
+        for size in SIZES
+        for _ in range(USERS)
+    ]
+    errors = compare(exact, model, vecs, K)
+    limits = TOLERANCES[codec]
+    assert errors["decode"] <= limits["decode"]
+    assert errors["score"] <= limits["score"]
+    assert errors["closest_sse"] <= limits["closest_sse"]
+    assert errors["topk_overlap"] >= limits["topk_overlap"]
+
+
+@pytest.mark.parametrize("codec", ["float64", "float16", "uint8"])
+def test_round_trip(codec):
+    data = np.array([0.0, 12.5, 50.0, 99.0, 100.0])
+    stored, params = encode(data, codec)
+    decoded = decode(stored, params)
+    assert np.abs(np.asarray(decoded) - data).max() <= TOLERANCES.get(codec, {"decode": 0.0})["decode"]
+    assert np.array_equal(decoded[[1, 3]], np.asarray(decoded)[[1, 3]])
+
+
+def test_critic_means(exact):
+    means = critic_means(exact.matcher.csr, exact.shape[0])
+    csr = exact.matcher.csr
+    for row in (0, 1, exact.shape[0] - 1):
+        scores = csr.data[csr.indptr[row] : csr.indptr[row + 1]]
+        assert means[row] == pytest.approx(scores.mean() if len(scores) else 0.0)
+    assert np.array_equal(exact.critic_means, means)
@@ -0,0 +1,73 @@
+"""
+Bearer token verification with cached claims and subjects, so an
+authenticated request with a warm cache makes no database query.
+"""
+import time
+
+from jose import JWTError, jwt
+
+from cache import LRUCache
+
+
+class TokenVerifier:
+    def __init__(self, secret_key, algorithm, lookup_user, maxsize, ttl):
+        """
+        @param:
+        secret_key, algorithm - JWT signing parameters
+        lookup_user - coroutine function email -> user, None if the account doesn't exist
+        maxsize - int maximum number of cached tokens and subjects, each
+        ttl - float seconds a validated subject or decoded token is trusted
+        """
+        self.secret_key = secret_key
+        self.algorithm = algorithm
+        self.lookup_user = lookup_user
+        self.claims = LRUCache(maxsize, ttl)  # token -> decoded claims
+        self.subjects = LRUCache(maxsize, ttl)  # email -> user
+
+    def decode(self, token):
+        """
+        @return:
+        claims - dict, None if the token is invalid or expired
+        """
+        claims = self.claims.get(token)
+        if claims is not None:
+            return claims
+
+        try:
+            claims = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
+        except JWTError:
+            return None
+
+        # Never trust a cached token past its own expiry
+        ttl = self.claims.ttl
+        if "exp" in claims:
+            ttl = min(ttl, claims["exp"] - time.time())
+        if ttl > 0:
+            self.claims.put(token, claims, ttl)
+        return claims
+
+    async def verify(self, token):
+        """
+        @return:
+        user - the token's subject, None if the token or account is invalid
+        """
+        claims = self.decode(token)
+        if claims is None or claims.get("sub") is None:
+            return None
+
+        email = claims["sub"]
+        user = self.subjects.get(email)
+        if user is None:
+            user = await self.lookup_user(email)
+            if user is not None:
+                self.subjects.put(email, user)
+        return user
+
+    def invalidate(self, email):
+        """
+        Forget a subject after its account changed
+        """
+        self.subjects.pop(email)
+
+    def stats(self):
+        return {"claims": self.claims.stats(), "subjects": self.subjects.stats()}
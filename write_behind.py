@@ -0,0 +1,398 @@
+"""
+Write-behind queue for user ratings.
+
+A rating is acknowledged once it is appended to a local log and on disk,
+and only then joins the pending set, which reads overlay on the database. A background task
+waits briefly so repeated ratings of a movie coalesce, then upserts the
+pending set in batches with one statement per batch, backing off while the
+database is failing. Flushed ratings leave the pending set, and the log is
+rewritten down to what is still pending.
+
+On startup the log is replayed into the pending set, so ratings
+acknowledged before a crash are still written. The log is one JSON record
+per line:
+
+    {"seq": 7, "email": "a@b.c", "movie": 13, "rating": 80.0}
+    {"seq": 8, "email": "a@b.c", "clear": true}
+
+A log belongs to one process at a time. It is locked while open, so a
+second process pointed at the same path gets LogLocked instead of
+compacting away ratings it doesn't hold.
+"""
+import asyncio
+import fcntl
+import itertools
+import json
+import os
+import random
+import time
+
+from metrics import RATING_FLUSHES, RATING_FLUSH_ROWS, RATINGS_PENDING, report_error
+
+
+FLUSH_DELAY = 0.05  # seconds to wait for more ratings before flushing
+FLUSH_BATCH = 500  # ratings per upsert
+RETRY_BASE = 0.5  # seconds, doubled after every failed flush
+RETRY_MAX = 30.0
+COMPACT_RECORDS = 10000  # log records before the log is rewritten to the pending set
+
+
+class LogLocked(Exception):
+    pass
+
+
+class RatingLog:
+    def __init__(self, path, fsync=True):
+        """
+        @param:
+        path - str log file, created if missing
+        fsync - bool wait for appended records to reach the disk before acknowledging
+        """
+        self.path = path
+        self.fsync = fsync
+        self.file = None  # opened for appending by replay
+        self.lock_file = None  # flock held from replay until close
+        self.records = 0  # records in the file, replayed ones included
+        self.appended = 0  # records appended by this process
+        self.synced = 0
+        self._syncing = None
+
+    def replay(self):
+        """
+        Read the log left by the last run and open it for appending
+
+        @return:
+        list of dict records in the order they were written, a torn last
+            record from a crash is skipped
+
+        @raise:
+        LogLocked - another process has the log open
+        """
+        self.lock()
+        records = []
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        report_error("rating_log", "replay", "skipped a malformed record")
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.records = len(records)
+        return records
+
+    def lock(self):
+        # A separate file, as rewrite replaces the log itself
+        self.lock_file = open(f"{self.path}.lock", "a")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock_file.close()
+            self.lock_file = None
+            raise LogLocked(f"{self.path} is open in another process")
+
+    def append(self, records):
+        self.file.write("".join(json.dumps(record) + "\n" for record in records))
+        self.file.flush()
+        self.records += len(records)
+        self.appended += len(records)
+
+    async def sync(self):
+        """
+        Wait until everything appended so far is on disk. Callers arriving
+        while an fsync runs share the next one, so one fsync covers a group
+        of ratings.
+        """
+        target = self.appended
+        while self.fsync and self.synced < target:
+            if self._syncing is None:
+                self._syncing = asyncio.ensure_future(self._fsync())
+            await asyncio.shield(self._syncing)
+
+    async def _fsync(self):
+        upto = self.appended
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, os.fsync, self.file.fileno())
+            self.synced = upto
+        finally:
+            self._syncing = None
+
+    @property
+    def busy(self):
+        return self._syncing is not None
+
+    def rewrite(self, records):
+        """
+        Atomically replace the log with the given records
+        """
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.file.close()
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.records = len(records)
+        self.synced = self.appended
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        if self.lock_file is not None:
+            self.lock_file.close()
+
+
+class RatingQueue:
+    def __init__(
+        self,
+        db,
+        log,
+        delay=FLUSH_DELAY,
+        batch=FLUSH_BATCH,
+        retry_base=RETRY_BASE,
+        retry_max=RETRY_MAX,
+        compact_records=COMPACT_RECORDS,
+    ):
+        """
+        @param:
+        db - Cockroach the ratings are flushed to
+        log - RatingLog
+        delay - float seconds a flush waits for more ratings
+        batch - int ratings per upsert
+        retry_base, retry_max - float seconds of backoff after a failed flush
+        compact_records - int log records before it is rewritten
+        """
+        self.db = db
+        self.log = log
+        self.delay = delay
+        self.batch = batch
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.compact_records = compact_records
+        self.pending = {}  # (email, movie) -> (rating, seq), in order of first write
+        self.users = {}  # email -> set of movies with a pending rating
+        self.unsynced = {}  # seq -> record appended to the log, not yet on disk
+        self.cleared = {}  # email -> seq of their last clear, while older records may be unsynced
+        self.seq = 0
+        self.flushes = 0  # successful flushes, a pull that spans one is retried
+        self.failures = 0
+        self.coalesced = 0
+        self.flushed_at = None
+        self._wakeup = None
+        self._task = None
+        self._flushing = None
+
+    def start(self):
+        """
+        Replay the log and start the flush task, on the running loop before
+        serving reads
+
+        @raise:
+        LogLocked - another process has the log open
+        OSError - the log couldn't be read
+        """
+        for record in self.log.replay():
+            self.apply(record)
+        self.cleared.clear()
+        self.compact(force=True)
+        self._wakeup = asyncio.Event()
+        if self.pending:
+            self._wakeup.set()
+        self._task = asyncio.ensure_future(self.run())
+
+    def apply(self, record):
+        # Records can reach here out of order when one fsync covers several,
+        # a record never replaces a newer one or outlives a newer clear
+        seq = record["seq"]
+        self.seq = max(self.seq, seq)
+        email = record["email"]
+        if record.get("clear"):
+            self.cleared[email] = max(self.cleared.get(email, 0), seq)
+            for movie in list(self.users.get(email, ())):
+                if self.pending[(email, movie)][1] < seq:
+                    self.remove((email, movie))
+            return
+        if seq < self.cleared.get(email, 0):
+            return
+        key = (email, record["movie"])
+        if key in self.pending:
+            if self.pending[key][1] > seq:
+                return
+            self.coalesced += 1
+        self.pending[key] = (record["rating"], seq)
+        self.users.setdefault(email, set()).add(record["movie"])
+
+    def remove(self, key):
+        del self.pending[key]
+        movies = self.users[key[0]]
+        movies.discard(key[1])
+        if not movies:
+            del self.users[key[0]]
+
+    def record(self, email, **fields):
+        self.seq += 1
+        return {"seq": self.seq, "email": email, **fields}
+
+    async def commit(self, records):
+        """
+        Log records and apply them once they are on disk. Until then a
+        compaction keeps them in the log, but they aren't flushed.
+
+        @return:
+        bool - True once the records are applied, False if they couldn't be logged
+        """
+        try:
+            self.log.append(records)
+        except OSError as e:
+            report_error("rating_log", "append", e)
+            return False
+        for record in records:
+            self.unsynced[record["seq"]] = record
+        try:
+            await self.log.sync()
+            for record in records:
+                self.apply(record)
+            return True
+        except OSError as e:
+            report_error("rating_log", "sync", e)
+            return False
+        finally:
+            for record in records:
+                del self.unsynced[record["seq"]]
+            if not self.unsynced:
+                self.cleared.clear()
+            RATINGS_PENDING.set(len(self.pending))
+
+    async def put(self, email, ratings):
+        """
+        Queue ratings for a user
+
+        @param:
+        ratings - list of (movie, rating) pairs, later pairs for a movie win
+
+        @return:
+        bool - True once the ratings are in the log, they are never flushed otherwise
+        """
+        latest = {int(movie): float(rating) for movie, rating in ratings}
+        records = [self.record(email, movie=movie, rating=rating) for movie, rating in latest.items()]
+        if not await self.commit(records):
+            return False
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return True
+
+    def user_ratings(self, email):
+        """
+        @return:
+        dict movie -> rating of the user's pending ratings
+        """
+        return {movie: self.pending[(email, movie)][0] for movie in self.users.get(email, ())}
+
+    async def discard(self, email):
+        """
+        Drop a user's pending ratings before their ratings are deleted, and
+        wait for a flush in progress so it can't land after the delete
+
+        @return:
+        bool - True once the clear is in the log, the ratings mustn't be
+            deleted otherwise as a replay would bring the pending ones back
+        """
+        if not await self.commit([self.record(email, clear=True)]):
+            return False
+        if self._flushing is not None:
+            await asyncio.shield(self._flushing)
+        return True
+
+    async def flush(self):
+        """
+        Upsert the oldest pending ratings in one statement
+
+        @return:
+        bool - success
+        """
+        batch = list(itertools.islice(self.pending.items(), self.batch))
+        if not batch:
+            return True
+        rows = [(email, movie, rating) for (email, movie), (rating, _) in batch]
+        done = self._flushing = asyncio.get_event_loop().create_future()
+        try:
+            succ = await self.db.send_ratings_batch(rows)
+        finally:
+            done.set_result(None)
+            if self._flushing is done:
+                self._flushing = None
+
+        RATING_FLUSHES.inc("ok" if succ else "failed")
+        if not succ:
+            self.failures += 1
+            return False
+        RATING_FLUSH_ROWS.observe(len(rows))
+        for key, value in batch:
+            # A newer rating that arrived during the flush stays pending
+            if self.pending.get(key) == value:
+                self.remove(key)
+        self.flushes += 1
+        self.flushed_at = time.time()
+        RATINGS_PENDING.set(len(self.pending))
+        return True
+
+    def compact(self, force=False):
+        """
+        Rewrite the log to the pending set, which is all it still has to say,
+        once everything is flushed or it has grown past compact_records
+        """
+        if self.log.busy or self.log.records == 0:
+            return
+        if not (force or not self.pending or self.log.records >= self.compact_records):
+            return
+        records = [
+            {"seq": seq, "email": email, "movie": movie, "rating": rating}
+            for (email, movie), (rating, seq) in self.pending.items()
+        ] + [
+            record for record in self.unsynced.values()
+            if record.get("clear") or record["seq"] > self.cleared.get(record["email"], 0)
+        ]
+        try:
+            self.log.rewrite(sorted(records, key=lambda record: record["seq"]))
+        except OSError as e:
+            report_error("rating_log", "compact", e)
+
+    async def run(self):
+        backoff = self.retry_base
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.delay)
+            self._wakeup.clear()
+            while self.pending:
+                if await self.flush():
+                    backoff = self.retry_base
+                    self.compact()
+                    continue
+                await asyncio.sleep(backoff * random.uniform(0.5, 1.0))
+                backoff = min(backoff * 2, self.retry_max)
+
+    async def close(self):
+        """
+        Stop the flush task and try one last flush of everything pending
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        while self.pending and await self.flush():
+            pass
+        self.compact(force=True)
+        self.log.close()
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "coalesced": self.coalesced,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "flushed_at": self.flushed_at,
+            "log_records": self.log.records,
+        }